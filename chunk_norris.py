@@ -15,20 +15,111 @@ import sys
 import concurrent.futures
 import shutil
 import argparse
+import bisect
+import heapq
 import csv
 import ffmpeg
 import math
 import json
 import configparser
-import copy
 import shlex
 import logging
-from datetime import datetime
+import time
+import threading
+from datetime import timedelta
 from tqdm import tqdm
 
+# Number of logical processors, looked up once
+_CPU_COUNT = os.cpu_count() or 1
+
+# Decoder and encoder processes of the running chunk encodes, and the flag that stops the encoding phase after a failure
+_RUNNING_PROCESSES = set()
+_RUNNING_PROCESSES_LOCK = threading.Lock()
+_ENCODE_ABORT = threading.Event()
+
+# A grain table section: the 'E' header line followed by its 7 parameter lines
+_SECTION_RE = re.compile(r'^E[^\n]*\n(?:[^\n]*\n){7}', re.MULTILINE)
+
+# Frame rate of the input stream or timestamp of a scene change in the ffmpeg metadata output
+_FFSCD_LOG_RE = re.compile(rb'Stream #0:[^\n]*?(\d+\.\d+)\s*fps,|pts_time:(\d+(?:\.\d+)?)')
+
+# Script lines calling DGSource and the end of their .dgi file argument, for adding h2s_enable
+_DGSOURCE_LINE_RE = re.compile(r'^.*dgsource.*$', re.IGNORECASE | re.MULTILINE)
+_DGI_RE = re.compile(r'\.dgi"([,)])')
+
+# Bit depth at the end of a high bit depth pixel format name
+_PIX_FMT_BITDEPTH_RE = re.compile(r'(\d+)[lb]e$')
+
+# Values of the master display string and the factors converting them from the x265 units
+_MASTER_DISPLAY_RE = re.compile(r'([A-Z]+)\((\d+),(\d+)\)')
+_MASTER_DISPLAY_FACTORS = {'G': 0.00002, 'B': 0.00002, 'R': 0.00002, 'WP': 0.00002, 'L': 0.0001}
+
+# Widths supported by grav1synth, the FGS analysis video is padded to the next one of these
+_GRAIN_PAD_WIDTHS = (1280, 1480, 1920, 2560, 3584, 3840)
+
+# Names of the master display and content light level parameters of the encoders supporting them
+_HDR_PARAM_NAMES = {'rav1e': ('mastering-display', 'content-light'), 'svt': ('mastering-display', 'content-light'), 'x265': ('master-display', 'max-cll')}
+# x265 signaling for PQ sources
+_X265_HDR10_PARAMS = {'colorprim': 9, 'transfer': 16, 'colormatrix': 9, 'chromaloc': 2, 'hdr10': "", 'hdr10-opt': "", 'repeat-headers': ""}
+
+# Name of the film grain table parameter of the AV1 encoders
+_FGS_TABLE_PARAM = {'svt': 'fgs-table', 'rav1e': 'film-grain-table', 'aom': 'film-grain-table'}
+
+# Faster x265 settings for the Q analysis encode, keyed by the parameter name
+_X265_QADJUST_REPLACEMENTS = {'preset': 'fast',
+                              'limit-refs': 3,
+                              'rdoq-level': 2,
+                              'rc-lookahead': 40,
+                              'lookahead-slices': 0,
+                              'b-adapt': 2}
+
+
+# Create the command line arguments of the non-empty parameters in the encoder supported format
+def format_params(encode_params, encoder):
+    params = []
+    for key, value in encode_params.items():
+        if value is None:
+            continue
+        if encoder == 'aom':
+            params.append(f"--{key}={value}")
+        else:
+            params.append(f"--{key}")
+            if value != '':
+                params.append(str(value))
+    return params
+
+
+# Create the parameters as a single command line string for displaying
+def display_params(encode_params, encoder):
+    return subprocess.list2cmdline(format_params(encode_params, encoder))
+
+
+# Probe the video, reusing the stored result as long as the file has not changed
+# Only the script file itself is tracked, edits to imported scripts or a replaced source are not noticed
+# This runs before the logging is set up, so only print is used here, a logging call would keep the log file from being created
+def probe_video(video_path):
+    stat = os.stat(video_path)
+    cache_key = [os.path.abspath(video_path), stat.st_mtime_ns, stat.st_size]
+    cache_file = os.path.splitext(video_path)[0] + '.probe.json'
+    try:
+        with open(cache_file, 'r') as file:
+            cache = json.load(file)
+        if cache['key'] == cache_key:
+            print(f"Using the stored video properties from {cache_file}, delete it if the source has changed.\n")
+            return cache['probe']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    probe = ffmpeg.probe(video_path, v='error', select_streams='v:0')
+    try:
+        with open(cache_file, 'w') as file:
+            json.dump({'key': cache_key, 'probe': probe}, file)
+    except OSError as e:
+        print(f"Could not store the probe results to {cache_file}. Exception code {e}")
+    return probe
+
 
 def get_video_props(video_path):
-    probe = ffmpeg.probe(video_path, v='error')
+    probe = probe_video(video_path)
     video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), None)
     if video_stream:
         video_width = int(video_stream['width'])
@@ -38,6 +129,9 @@ def get_video_props(video_path):
         num, denom = map(int, video_framerate.split('/'))
         fr = float(num/denom)
         video_framerate = int(math.ceil(num/denom))
+        # The pixel format name ends in the bit depth for high bit depth formats, e.g. yuv420p10le
+        bitdepth_match = _PIX_FMT_BITDEPTH_RE.search(video_stream.get('pix_fmt', ''))
+        video_bitdepth = int(bitdepth_match.group(1)) if bitdepth_match else 8
         try:
             video_transfer = str(video_stream['color_transfer'])
         except Exception as e:
@@ -59,51 +153,38 @@ def get_video_props(video_path):
         video_matrix = video_matrix.replace("smpte", "")
         video_matrix = video_matrix.replace("unknown", "709")
 
-        return video_width, video_height, video_length, video_transfer, video_matrix, video_framerate, fr
+        return video_width, video_height, video_length, video_transfer, video_matrix, video_framerate, fr, video_bitdepth
     else:
         print("No video stream found in the input video.")
         return None
 
 
-# Function to clean up a folder
+# Remove the contents of the folder but keep the folder itself, it may be open in a shell or Explorer window
 def clean_folder(folder):
-    for item in os.listdir(folder):
-        item_path = os.path.join(folder, item)
-        if os.path.isfile(item_path):
-            os.unlink(item_path)
-        elif os.path.isdir(item_path):
-            shutil.rmtree(item_path)
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
 
 
 def clean_files(folder, pattern):
-    for item in os.listdir(folder):
-        item_path = os.path.join(folder, item)
-        if os.path.isfile(item_path) and item.startswith(pattern):
-            os.unlink(item_path)
+    # scandir returns the file type with the directory listing, so no extra stat is needed per file
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.startswith(pattern) and entry.is_file(follow_symlinks=False):
+                os.unlink(entry.path)
 
 
 # Define a function to extract sections from the baseline grain table file
 def extract_sections(filename):
-    sections = []
-    current_section = []
-    section_number = 0  # Track the current section number
-
     with open(filename, 'r') as file:
-        for line in file:
-            if line.startswith('E'):
-                # If we encounter a line starting with 'E', it's the start of a new section
-                current_section = [line]
-                section_number += 1  # Increment section number
-                # print(f"Processing section {section_number}...")
-            elif current_section:
-                # If we are in a section, add the line to the current section
-                current_section.append(line)
-
-            if len(current_section) == 8:  # Each section has 8 lines, including the header
-                sections.append(current_section)
-                # length = timestamp_difference(current_section)
-                # print (length)
-                current_section = []
+        data = file.read()
+    if not data.endswith('\n'):
+        data += '\n'
+    # Each section has 8 lines, starting with the header line beginning with 'E'
+    sections = [section.group(0).splitlines(keepends=True) for section in _SECTION_RE.finditer(data)]
 
     if not sections:
         print("No valid sections found in the file.")
@@ -112,9 +193,14 @@ def extract_sections(filename):
 
 # Define a function to calculate the timestamp difference for a section in the baseline grain table
 def timestamp_difference(section):
-    start_timestamp = int(section[0].split()[1])
-    end_timestamp = int(section[0].split()[2])
-    return end_timestamp - start_timestamp
+    # Only the two timestamps after the 'E' are needed from the header
+    start_timestamp, end_timestamp = section[0].split(None, 3)[1:3]
+    return int(end_timestamp) - int(start_timestamp)
+
+
+# Enable the HDR to SDR conversion of DGSource on the script lines which load a .dgi file, works on a single line or a whole script
+def enable_dgsource_h2s(source):
+    return _DGSOURCE_LINE_RE.sub(lambda line: _DGI_RE.sub(r'.dgi",h2s_enable=1\1', line.group(0)), source)
 
 
 def create_scxvid_file(scene_change_csv, scd_method, scd_tonemap, encode_script, cudasynth, downscale_scd, scd_script, scene_change_file_path):
@@ -122,34 +208,28 @@ def create_scxvid_file(scene_change_csv, scd_method, scd_tonemap, encode_script,
         with open(encode_script, 'r') as file:
             # Read the first line from the original file
             source = file.readline()
-            if scd_tonemap != 0 and cudasynth and "dgsource" in source.lower():
-                source = source.replace(".dgi\",", ".dgi\",h2s_enable=1,")
-                source = source.replace(".dgi\")", ".dgi\",h2s_enable=1)")
+            if scd_tonemap != 0 and cudasynth:
+                source = enable_dgsource_h2s(source)
+        # Start the new script with the first line content
+        script_lines = [source]
+        if downscale_scd > 1:
+            script_lines.append(f'\nSpline16Resize(width()/{downscale_scd},height()/{downscale_scd})\nCrop(16,16,-16,-16)\n')
+        if scd_tonemap != 0 and not cudasynth:
+            script_lines.append('\nConvertBits(16).DGHDRtoSDR(gamma=1/2.4)\n')
+        script_lines.append(f'ConvertBits(8)\nSCXvid(log="{scene_change_csv}")')
         with open(scd_script, 'w') as scd_file:
-            # Write the first line content to the new file
-            scd_file.write(source)
-            if downscale_scd > 1:
-                scd_file.write('\n')
-                scd_file.write(f'Spline16Resize(width()/{downscale_scd},height()/{downscale_scd})\n')
-                scd_file.write('Crop(16,16,-16,-16)\n')
-            if scd_tonemap != 0 and not cudasynth:
-                scd_file.write('\nConvertBits(16).DGHDRtoSDR(gamma=1/2.4)\n')
-            scd_file.write('ConvertBits(8)\n')
-            scd_file.write(f'SCXvid(log="{scene_change_csv}")')
+            scd_file.writelines(script_lines)
     else:
         with open(encode_script, 'r') as file:
-            # Read the first line from the original file
-            source = file.readlines()
-            for i in range(len(source)):
-                if scd_tonemap != 0 and cudasynth and "dgsource" in source[i].lower():
-                    source[i] = source[i].replace(".dgi\",", ".dgi\",h2s_enable=1,")
-                    source[i] = source[i].replace(".dgi\")", ".dgi\",h2s_enable=1)")
+            # Read the whole original script, the DGSource lines are patched in one pass over the text
+            source = file.read()
+            if scd_tonemap != 0 and cudasynth:
+                source = enable_dgsource_h2s(source)
+        if scd_tonemap != 0 and not cudasynth:
+            source += '\nConvertBits(16).DGHDRtoSDR(gamma=1/2.4)\n'
+        source += f'\nConvertBits(bits=8)\nSCXvid(log="{scene_change_csv}")'
         with open(scd_script, 'w') as scd_file:
-            scd_file.writelines(source)
-            if scd_tonemap != 0 and not cudasynth:
-                scd_file.write('\nConvertBits(16).DGHDRtoSDR(gamma=1/2.4)\n')
-            scd_file.write(f'\nConvertBits(bits=8)\n')
-            scd_file.write(f'SCXvid(log="{scene_change_csv}")')
+            scd_file.write(source)
 
     scene_change_command = [
         "ffmpeg",
@@ -158,51 +238,39 @@ def create_scxvid_file(scene_change_csv, scd_method, scd_tonemap, encode_script,
         "-an", "-f", "null", "NUL"
     ]
 
-    start_time = datetime.now()
+    start_time = time.monotonic()
     print("Detecting scene changes using SCXviD.\n")
-    scd_process = subprocess.Popen(scene_change_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    scd_process.communicate()
+    scd_process = subprocess.run(scene_change_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     if scd_process.returncode != 0:
         logging.error(f"Error in scene change detection phase, return code: {scd_process.returncode}")
         print("Error in scene change detection phase, return code:", scd_process.returncode)
         sys.exit(1)
-    end_time = datetime.now()
-    scd_time = end_time - start_time
+    end_time = time.monotonic()
+    scd_time = timedelta(seconds=end_time - start_time)
     logging.info(f"Scene change detection done, duration {scd_time}.")
 
     print("Converting logfile to QP file format.\n")
 
-    # Read the input file
-    with open(scene_change_csv, "r") as file:
-        scdxvid_data = file.readlines()
-
-    # Initialize variables
-    output_lines = []
-    current_line_number = -3  # The actual data starts from line 4, so this ensures the first scene change has frame number 0.
-
-    # Iterate through the lines
-    for line in scdxvid_data:
-        # Split the line into tokens
-        tokens = line.strip().split()
-
-        # Check if the line starts with 'i'
-        if tokens and tokens[0] == 'i':
-            # Append the current line number and 'I' to the output
-            output_lines.append(f"{current_line_number} I")
-        current_line_number += 1
-
-    # Join the output lines
-    scenechangelist = '\n'.join(output_lines)
-
-    # Write the output to a new file or print it
     qpfile = os.path.splitext(os.path.basename(encode_script))[0] + ".qp.txt"
     qpfile = os.path.join(scene_change_file_path, qpfile)
-    with open(qpfile, "w") as file:
-        file.write(scenechangelist)
+
+    # Every line whose first token is 'i' is a scene change. The actual data starts from line 4,
+    # so numbering from -3 ensures the first scene change has frame number 0.
+    # The log is streamed straight into the QP file, one line per scene change.
+    with open(scene_change_csv, "rb") as log_file, open(qpfile, "w") as file:
+        separator = ''
+        for line_number, line in enumerate(log_file, -3):
+            if line[:1] == b'i' and line.split(None, 1)[0] == b'i':
+                file.write(f"{separator}{line_number} I")
+                separator = '\n'
 
 
 # Function to find the scene change file recursively
 def find_scene_change_file(start_dir, filename):
+    # The QP file is normally created next to the encode script, so check there before walking the tree
+    direct_path = os.path.join(start_dir, filename)
+    if os.path.isfile(direct_path):
+        return direct_path
     for root, dirs, files in os.walk(start_dir):
         if filename in files:
             return os.path.join(root, filename)
@@ -222,11 +290,10 @@ def ffscd(scd_script, scdthresh, scene_change_csv):
     ]
 
     # Redirect stderr to the CSV file
-    start_time = datetime.now()
+    start_time = time.monotonic()
     print("Detecting scene changes using ffmpeg.\n")
     with open(scene_change_csv, "w") as stderr_file:
-        scd_process = subprocess.Popen(scene_change_command, stdout=subprocess.PIPE, stderr=stderr_file, shell=True)
-        scd_process.communicate()
+        scd_process = subprocess.run(scene_change_command, stdout=subprocess.DEVNULL, stderr=stderr_file)
         if scd_process.returncode != 0:
             logging.error(f"Error in scene change detection, return code: {scd_process.returncode}")
             print("Error in scene change detection, return code:", scd_process.returncode)
@@ -235,46 +302,65 @@ def ffscd(scd_script, scdthresh, scene_change_csv):
         # Step 2: Split the Encode into Chunks
         scene_changes = [0]
 
-        # Initialize variables to store frame rate and frame number
+        # Initialize variables to store frame rate and scene change timestamps
         frame_rate = None
+        scene_times = []
+
+        # The log is read as bytes in one go and scanned once for both values, float() parses them without decoding
+        with open(scene_change_csv, "rb") as csv_file:
+            data = csv_file.read()
+        error_index = data.find(b"error")
+        if error_index != -1:
+            line_start = data.rfind(b"\n", 0, error_index) + 1
+            line_end = data.find(b"\n", error_index)
+            line = data[line_start:line_end if line_end != -1 else len(data)].decode(errors='replace')
+            logging.error(f"Error in scene change detection, error message: {line}")
+            logging.error(f"More details in {scene_change_csv}.")
+            print("Scene change detection reported an error, exiting.")
+            print(f"Error message: {line}")
+            print(f"More details in {scene_change_csv}.")
+            sys.exit(1)
+        for match in _FFSCD_LOG_RE.finditer(data):
+            fps, pts_time = match.groups()
+            if fps is not None:
+                frame_rate = float(fps)
+            else:
+                scene_times.append(float(pts_time))
 
-        # Function to check if a line contains 'pts_time' information
-        def has_pts_time(line):
-            return 'pts_time' in line and ':' in line
-
-        with open(scene_change_csv, "r") as csv_file:
-            for line in csv_file:
-                if "error" in line:
-                    logging.error(f"Error in scene change detection, error message: {line}")
-                    logging.error(f"More details in {scene_change_csv}.")
-                    print("Scene change detection reported an error, exiting.")
-                    print(f"Error message: {line}")
-                    print(f"More details in {scene_change_csv}.")
-                    sys.exit(1)
-                if "Stream #0:" in line and "fps," in line:
-                    # Extract frame rate using regular expression
-                    match = re.search(r"(\d+\.\d+)\s*fps,", line)
-                    if match:
-                        frame_rate = float(match.group(1))
-                elif has_pts_time(line):
-                    parts = line.split("pts_time:")
-                    if len(parts) == 2:
-                        try:
-                            scene_time = float(parts[1].strip())
-                            # Calculate frame number based on pts_time and frame rate
-                            scene_frame = int(scene_time * frame_rate)
-                            scene_changes.append(scene_frame)
-                        except ValueError:
-                            print(f"Error converting to float: {line}")
+        # Calculate frame numbers based on pts_time and frame rate
+        scene_changes.extend(int(scene_time * frame_rate) for scene_time in scene_times)
 
         # print("scene_changes:", scene_changes)
-        end_time = datetime.now()
-        scd_time = end_time - start_time
+        end_time = time.monotonic()
+        scd_time = timedelta(seconds=end_time - start_time)
         logging.info(f"Scene change detection done, duration {scd_time}.")
 
         return scene_changes
 
 
+# Function to detect scene changes with ffmpeg, reusing the stored result as long as the script, the threshold and the video length have not changed
+# Only the script file itself is tracked, edits to imported scripts or a replaced source of the same length are not noticed
+def cached_ffscd(scd_script, scdthresh, scene_change_csv, cache_file, video_length):
+    stat = os.stat(scd_script)
+    cache_key = [os.path.abspath(scd_script), stat.st_mtime_ns, stat.st_size, scdthresh, video_length]
+    try:
+        with open(cache_file, 'r') as file:
+            cache = json.load(file)
+        if cache['key'] == cache_key:
+            print(f"Using the stored scene changes from {cache_file}, delete it if the source has changed.\n")
+            logging.info(f"Scene changes read from {cache_file}.")
+            return cache['scene_changes']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    scene_changes = ffscd(scd_script, scdthresh, scene_change_csv)
+    try:
+        with open(cache_file, 'w') as file:
+            json.dump({'key': cache_key, 'scene_changes': scene_changes}, file)
+    except OSError as e:
+        logging.warning(f"Could not store the scene changes to {cache_file}. Exception code {e}")
+    return scene_changes
+
+
 # Function to detect scene changes with PySceneDetect
 def pyscd(scd_script, output_folder_name, scdthresh, min_chunk_length, scene_change_csv):
     scene_change_command = [
@@ -291,19 +377,35 @@ def pyscd(scd_script, output_folder_name, scdthresh, min_chunk_length, scene_cha
         "-q"
     ]
     print("Detecting scene changes using PySceneDetect.\n")
-    start_time = datetime.now()
-    scd_process = subprocess.Popen(scene_change_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    scd_process.communicate()
+    start_time = time.monotonic()
+    scd_process = subprocess.run(scene_change_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     if scd_process.returncode != 0:
         logging.error(f"Error in scene change detection, return code: {scd_process.returncode}")
         print("Error in scene change detection, return code:", scd_process.returncode)
         sys.exit(1)
-    end_time = datetime.now()
-    scd_time = end_time - start_time
+    end_time = time.monotonic()
+    scd_time = timedelta(seconds=end_time - start_time)
     logging.info(f"Scene change detection done, duration {scd_time}.")
 
 
-def create_fgs_table(encode_params, output_grain_table, scripts_folder, video_width, encode_script, graintable_sat, decode_method, encoder, threads, cpu, graintable_cpu, output_grain_file_encoded, output_grain_file_lossless,
+# Copy the decoded video to every consumer, closing their input when the source ends or a consumer fails
+def tee_stream(source, destinations):
+    try:
+        while block := source.read(1 << 20):
+            for destination in destinations:
+                destination.write(block)
+    except OSError as e:
+        logging.error(f"Error while passing the decoded video to the encoders. Exception code {e}")
+    finally:
+        for destination in destinations:
+            try:
+                destination.close()
+            except OSError:
+                pass
+        source.close()
+
+
+def create_fgs_table(encode_params, output_grain_table, scripts_folder, video_width, encode_script, graintable_sat, decode_method, encoder, graintable_cpu, output_grain_file_encoded, output_grain_file_lossless,
                      output_grain_table_baseline):
     # Create the grain table only if it doesn't exist already
     if os.path.exists(output_grain_table) is False:
@@ -313,108 +415,83 @@ def create_fgs_table(encode_params, output_grain_table, scripts_folder, video_wi
 
         # Check the need to pad the video because grav1synth :/
         # This check and workaround currently supports resolutions only up to 4K
-        padleft = 0
-        padright = 0
-        if 3584 < video_width < 3840:
-            padleft = (3840 - video_width) / 2
-            if padleft % 2 != 0:
-                padleft += 1
-            padright = 3840 - video_width - padleft
-        elif 2560 < video_width < 3584:
-            padleft = (3584 - video_width) / 2
-            if padleft % 2 != 0:
-                padleft += 1
-            padright = 3584 - video_width - padleft
-        elif 1920 < video_width < 2560:
-            padleft = (2560 - video_width) / 2
-            if padleft % 2 != 0:
-                padleft += 1
-            padright = 2560 - video_width - padleft
-        elif 1480 < video_width < 1920:
-            padleft = (1920 - video_width) / 2
-            if padleft % 2 != 0:
-                padleft += 1
-            padright = 1920 - video_width - padleft
-        elif 1280 < video_width < 1480:
-            padleft = (1480 - video_width) / 2
-            if padleft % 2 != 0:
-                padleft += 1
-            padright = 1480 - video_width - padleft
-        elif video_width < 1280:
-            padleft = (1280 - video_width) / 2
-            if padleft % 2 != 0:
-                padleft += 1
-            padright = 1280 - video_width - padleft
+        # Pad to the next supported width, unless the width already is one of them or is above 4K
+        target_index = bisect.bisect_left(_GRAIN_PAD_WIDTHS, video_width)
+        if target_index < len(_GRAIN_PAD_WIDTHS):
+            pad_total = _GRAIN_PAD_WIDTHS[target_index] - video_width
+        else:
+            pad_total = 0
+        # Keep the left padding even
+        padleft = (pad_total // 2 + 1) & ~1
+        padright = pad_total - padleft
 
         print("\nVideo width:", video_width)
         print("Padding left:", padleft)
         print("Padding right:", padright)
         print("Final width:", video_width + padleft + padright)
 
+        script_lines = [f'Import("{encode_script}")\n']
+        if referencefile_end_frame != '':
+            script_lines.append(f'Trim({referencefile_start_frame}, {referencefile_end_frame})\n')
+        else:
+            script_lines.append('grain_frame_rate = Ceil(FrameRate())\n'
+                                f'grain_end_frame = {referencefile_start_frame} + (grain_frame_rate * 5)\n'
+                                f'Trim({referencefile_start_frame}, grain_end_frame)\n')
+        if graintable_sat < 1.0:
+            script_lines.append(f'Tweak(sat={graintable_sat})\n')
+        script_lines.append(f'ConvertBits(10)\nAddBorders({padleft},0,{padright},0)')
         with open(grain_script, 'w') as grain_file:
-            grain_file.write(f'Import("{encode_script}")\n')
-            if referencefile_end_frame != '':
-                grain_file.write(f'Trim({referencefile_start_frame}, {referencefile_end_frame})\n')
-                if graintable_sat < 1.0:
-                    grain_file.write(f'Tweak(sat={graintable_sat})\n')
-                grain_file.write('ConvertBits(10)\n')
-                grain_file.write(f'AddBorders({int(padleft)},0,{int(padright)},0)')
-            else:
-                grain_file.write('grain_frame_rate = Ceil(FrameRate())\n')
-                grain_file.write(f'grain_end_frame = {referencefile_start_frame} + (grain_frame_rate * 5)\n')
-                grain_file.write(f'Trim({referencefile_start_frame}, grain_end_frame)\n')
-                if graintable_sat < 1.0:
-                    grain_file.write(f'Tweak(sat={graintable_sat})\n')
-                grain_file.write('ConvertBits(10)\n')
-                grain_file.write(f'AddBorders({int(padleft)},0,{int(padright)},0)')
+            grain_file.writelines(script_lines)
 
         # Create the encoding command lines
         if decode_method == 0:
             decode_command_grain = [
                 "avs2yuv64.exe",
                 "-no-mt",
-                '"' + grain_script + '"',
+                grain_script,
                 "-"
             ]
         else:
             decode_command_grain = [
                 "ffmpeg.exe",
                 "-loglevel", "fatal",
-                "-i", '"' + grain_script + '"',
+                "-i", grain_script,
                 "-f", "yuv4mpegpipe",
                 "-strict", "-1",
                 "-"
             ]
 
         if encoder == 'rav1e':
-            encode_params_grain = [x.replace(f'--threads {threads}', '--threads 0').replace(f'--speed {cpu}', f'--speed {graintable_cpu}') for x in encode_params]
+            encode_params_grain = {**encode_params, 'threads': 0, 'speed': graintable_cpu}
             enc_command_grain = [
                 "rav1e.exe",
-                *encode_params_grain,
-                "-o", '"' + output_grain_file_encoded + '"',
+                *format_params(encode_params_grain, encoder),
+                "-o", output_grain_file_encoded,
                 "-"
             ]
         elif encoder == 'svt':
-            encode_params_grain = [x.replace(f'--lp {threads}', '--lp 0').replace(f'--preset {cpu}', f'--preset {graintable_cpu}') for x in encode_params]
+            encode_params_grain = {**encode_params, 'lp': 0, 'preset': graintable_cpu}
             enc_command_grain = [
                 "svtav1encapp.exe",
-                *encode_params_grain,
-                "-b", '"' + output_grain_file_encoded + '"',
-                "-i -"
+                *format_params(encode_params_grain, encoder),
+                "-b", output_grain_file_encoded,
+                "-i", "-"
             ]
         else:
-            encode_params_grain = [x.replace(f'--cpu-used={cpu}', f'--cpu-used={graintable_cpu}').replace(f'--threads={threads}', f'--threads={os.cpu_count()}') for x in encode_params]
+            encode_params_grain = {**encode_params, 'cpu-used': graintable_cpu, 'threads': _CPU_COUNT}
             enc_command_grain = [
                 "aomenc.exe",
                 "--ivf",
-                *encode_params_grain,
+                *format_params(encode_params_grain, encoder),
                 "--passes=1",
-                "-o", '"' + output_grain_file_encoded + '"',
+                "-o", output_grain_file_encoded,
                 "-"
             ]
+        # The lossless file is encoded from the same decoded video as the AV1 file
         ffmpeg_command_grain = [
             "ffmpeg.exe",
-            "-i", grain_script,
+            "-f", "yuv4mpegpipe",
+            "-i", "-",
             "-y",
             "-loglevel", "fatal",
             "-c:v", "ffv1",
@@ -432,29 +509,30 @@ def create_fgs_table(encode_params, output_grain_table, scripts_folder, video_wi
         ]
 
         # print (avs2yuv_command_grain, enc_command_grain)
-        decode_command_grain = ' '.join(decode_command_grain)
-        enc_command_grain = ' '.join(enc_command_grain)
-        enc_command_grain = decode_command_grain + ' | ' + enc_command_grain
-
-        print("Encoding the FGS analysis AV1 file.")
-        enc_process_grain = subprocess.Popen(enc_command_grain, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        enc_process_grain.communicate()
+        # Decode the grain script once and feed it to both the AV1 and the lossless encoder at the same time
+        print("Encoding the FGS analysis AV1 and lossless files.")
+        decode_process_grain = subprocess.Popen(decode_command_grain, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=1 << 20)
+        enc_process_grain = subprocess.Popen(enc_command_grain, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, bufsize=1 << 20)
+        enc_process_grain_ffmpeg = subprocess.Popen(ffmpeg_command_grain, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, bufsize=1 << 20)
+        tee_stream(decode_process_grain.stdout, [enc_process_grain.stdin, enc_process_grain_ffmpeg.stdin])
+        enc_process_grain.wait()
+        enc_process_grain_ffmpeg.wait()
+        decode_process_grain.wait()
         if enc_process_grain.returncode != 0:
             logging.error(f"Error in FGS analysis encoder processing, return code: {enc_process_grain.returncode}")
             print("Error in FGS analysis encoder processing, return code:", enc_process_grain.returncode)
             sys.exit(1)
-
-        print("Encoding the FGS analysis lossless file.")
-        enc_process_grain_ffmpeg = subprocess.Popen(ffmpeg_command_grain, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        enc_process_grain_ffmpeg.communicate()
         if enc_process_grain_ffmpeg.returncode != 0:
             logging.error(f"Error in FGS analysis lossless file processing, return code: {enc_process_grain_ffmpeg.returncode}")
             print("Error in FGS analysis lossless file processing, return code:", enc_process_grain_ffmpeg.returncode)
             sys.exit(1)
+        if decode_process_grain.returncode != 0:
+            logging.error(f"Error in FGS analysis decoder processing, return code: {decode_process_grain.returncode}")
+            print("Error in FGS analysis decoder processing, return code:", decode_process_grain.returncode)
+            sys.exit(1)
 
         print("Creating the FGS grain table file.\n")
-        enc_process_grain_grav = subprocess.Popen(grav1synth_command, shell=True)
-        enc_process_grain_grav.communicate()
+        enc_process_grain_grav = subprocess.run(grav1synth_command)
         if enc_process_grain_grav.returncode != 0:
             logging.error(f"Error in grav1synth process, return code: {enc_process_grain_grav.returncode}")
             print("Error in grav1synth process, return code:", enc_process_grain_grav.returncode)
@@ -475,11 +553,11 @@ def create_fgs_table(encode_params, output_grain_table, scripts_folder, video_wi
         elif len(sections) >= 2:
             # Find the second-longest section based on timestamp difference
 
-            # Sort sections by timestamp difference in descending order
-            sorted_sections = sorted(sections, key=timestamp_difference, reverse=True)
+            # Only the two longest sections are needed, so there is no need to sort all of them
+            longest_sections = heapq.nlargest(2, sections, key=timestamp_difference)
 
             # The second-longest section is at index 1 (index 0 is the longest)
-            second_longest_section = sorted_sections[1]
+            second_longest_section = longest_sections[1]
 
             # Replace the header with one from the first section
             second_longest_section[0] = sections[0][0]
@@ -499,7 +577,7 @@ def create_fgs_table(encode_params, output_grain_table, scripts_folder, video_wi
         print("The FGS grain table file exists already, skipping creation.\n")
 
 
-def scene_change_detection(scd_script, scd_method, scdthresh, encode_script, scd_tonemap, cudasynth, downscale_scd, scene_change_csv, output_folder_name, min_chunk_length):
+def scene_change_detection(scd_script, scd_method, scdthresh, encode_script, scd_tonemap, cudasynth, downscale_scd, scene_change_csv, output_folder_name, min_chunk_length, scd_cache_file, video_length):
     scene_changes = []
     # Detect scene changes or use QP-file
     if scd_method in (0, 5, 6):
@@ -513,13 +591,10 @@ def scene_change_detection(scd_script, scd_method, scdthresh, encode_script, scd
             print(f"Scene change file not found: {scene_change_filename}")
             sys.exit(1)
 
-        # Read scene changes from the file
-        with open(scene_change_file_path, "r") as scene_change_file:
-            for line in scene_change_file:
-                parts = line.strip().split()
-                if len(parts) == 2:
-                    start_frame = int(parts[0])
-                    scene_changes.append(start_frame)
+        # Read scene changes from the file, each line holds the start frame and the frame type
+        with open(scene_change_file_path, "rb") as scene_change_file:
+            qp_lines = [line.split() for line in scene_change_file.read().splitlines()]
+        scene_changes = [int(parts[0]) for parts in qp_lines if len(parts) == 2]
         print("Read scene changes from QP file.\n")
 
         # Debug: Print the scene changes from the file
@@ -534,44 +609,37 @@ def scene_change_detection(scd_script, scd_method, scdthresh, encode_script, scd
             with open(encode_script, 'r') as file:
                 # Read the first line from the original file
                 source = file.readline()
-                if scd_tonemap != 0 and cudasynth and "dgsource" in source.lower():
-                    source = source.replace(".dgi\",", ".dgi\",h2s_enable=1,")
-                    source = source.replace(".dgi\")", ".dgi\",h2s_enable=1)")
-                with open(scd_script, 'w') as scd_file:
-                    # Write the first line content to the new file
-                    scd_file.write(source)
-                    if downscale_scd > 1:
-                        scd_file.write('\n')
-                        scd_file.write(f'Spline16Resize(width()/{downscale_scd},height()/{downscale_scd})\n')
-                        scd_file.write('Crop(16,16,-16,-16)')
-                    if scd_tonemap != 0 and not cudasynth:
-                        scd_file.write('\nConvertBits(16).DGHDRtoSDR(gamma=1/2.4)')
-            scene_changes = ffscd(scd_script, scdthresh, scene_change_csv)
+                if scd_tonemap != 0 and cudasynth:
+                    source = enable_dgsource_h2s(source)
+            # Start the new script with the first line content and write it out at once
+            if downscale_scd > 1:
+                source += f'\nSpline16Resize(width()/{downscale_scd},height()/{downscale_scd})\nCrop(16,16,-16,-16)'
+            if scd_tonemap != 0 and not cudasynth:
+                source += '\nConvertBits(16).DGHDRtoSDR(gamma=1/2.4)'
+            with open(scd_script, 'w') as scd_file:
+                scd_file.write(source)
+            scene_changes = cached_ffscd(scd_script, scdthresh, scene_change_csv, scd_cache_file, video_length)
         else:
             print(f"Using scene change analysis script: {scd_script}.\n")
-            scene_changes = ffscd(scd_script, scdthresh, scene_change_csv)
+            scene_changes = cached_ffscd(scd_script, scdthresh, scene_change_csv, scd_cache_file, video_length)
     elif scd_method == 2:
         print(f"Using scene change analysis script: {encode_script}.\n")
         scd_script = encode_script
-        scene_changes = ffscd(scd_script, scdthresh, scene_change_csv)
+        scene_changes = cached_ffscd(scd_script, scdthresh, scene_change_csv, scd_cache_file, video_length)
     elif scd_method == 3:
-        scd_script = os.path.splitext(os.path.basename(encode_script))[0] + "_scd.avs"
-        scd_script = os.path.join(os.path.dirname(encode_script), scd_script)
         if os.path.exists(scd_script) is False:
             print(f"Scene change analysis script not found: {scd_script}, created manually.\n")
             with open(encode_script, 'r') as file:
                 # Read the first line from the original file
                 source = file.readline()
-                if scd_tonemap != 0 and cudasynth and "dgsource" in source.lower():
-                    source = source.replace(".dgi\",", ".dgi\",h2s_enable=1,")
-                    source = source.replace(".dgi\")", ".dgi\",h2s_enable=1)")
-                with open(scd_script, 'w') as scd_file:
-                    # Write the first line content to the new file
-                    scd_file.write(source)
-                    scd_file.write(f'\nSpline16Resize(width()/{downscale_scd},height()/{downscale_scd})\n')
-                    scd_file.write('Crop(16,16,-16,-16)')
-                    if scd_tonemap != 0 and not cudasynth:
-                        scd_file.write('\nConvertBits(16).DGHDRtoSDR(gamma=1/2.4)')
+                if scd_tonemap != 0 and cudasynth:
+                    source = enable_dgsource_h2s(source)
+            # Start the new script with the first line content and write it out at once
+            source += f'\nSpline16Resize(width()/{downscale_scd},height()/{downscale_scd})\nCrop(16,16,-16,-16)'
+            if scd_tonemap != 0 and not cudasynth:
+                source += '\nConvertBits(16).DGHDRtoSDR(gamma=1/2.4)'
+            with open(scd_script, 'w') as scd_file:
+                scd_file.write(source)
             pyscd(scd_script, output_folder_name, scdthresh, min_chunk_length, scene_change_csv)
         else:
             print(f"Using scene change analysis script: {scd_script}.\n")
@@ -584,32 +652,18 @@ def scene_change_detection(scd_script, scd_method, scdthresh, encode_script, scd
 
 
 def adjust_chunkdata(chunkdata_list, credits_start_frame, min_chunk_length, q, credits_q):
-    adjusted_chunkdata_list = []
-
     last_frame = chunkdata_list[-1]['end']
 
-    for i, chunkdata in enumerate(chunkdata_list):
-        if chunkdata['start'] <= credits_start_frame <= chunkdata['end']:
-            # Update the end frame of the chunk where credits start
-            adjusted_length = credits_start_frame - chunkdata['start']
-            chunkdata_list[i]['end'] = credits_start_frame - 1
-            chunkdata_list[i]['length'] = adjusted_length
-            break
-        elif i == len(chunkdata_list) - 1 and credits_start_frame == chunkdata['end'] + 1:
-            # Credits start at the end of the last chunk
-            adjusted_chunk = {
-                'chunk': chunkdata['chunk'],
-                'length': credits_start_frame - chunkdata['start'],
-                'start': chunkdata['start'],
-                'end': credits_start_frame - 1,
-                'credits': 0,
-                'q': q
-            }
-            adjusted_chunkdata_list.append(adjusted_chunk)
-            break
+    # The chunks are in frame order, so the last chunk starting at or before the credits is found by bisecting the start frames
+    credits_index = bisect.bisect_right(chunkdata_list, credits_start_frame, key=lambda chunkdata: chunkdata['start'])
 
     # Remove chunks that start after the credits start frame
-    chunkdata_list = [chunkdata for chunkdata in chunkdata_list if chunkdata['start'] <= credits_start_frame]
+    chunkdata_list = chunkdata_list[:credits_index]
+
+    if chunkdata_list and credits_start_frame <= chunkdata_list[-1]['end']:
+        # Update the end frame of the chunk where credits start
+        chunkdata_list[-1]['end'] = credits_start_frame - 1
+        chunkdata_list[-1]['length'] = credits_start_frame - chunkdata_list[-1]['start']
 
     # Check if the last chunk before the credits is too short
     if len(chunkdata_list) > 1 and chunkdata_list[-1]['length'] < min_chunk_length:
@@ -628,56 +682,31 @@ def adjust_chunkdata(chunkdata_list, credits_start_frame, min_chunk_length, q, c
         'q': credits_q
     }
 
-    # Append the adjusted chunks to the list
-    adjusted_chunkdata_list = chunkdata_list + [credits_chunk]
+    # Append the credits chunk to the list, the lengths of the other chunks are already up to date
+    chunkdata_list.append(credits_chunk)
 
-    # Update the length of each chunk in the adjusted_chunkdata_list
-    for chunkdata in adjusted_chunkdata_list:
-        chunkdata['length'] = chunkdata['end'] - chunkdata['start'] + 1
+    return chunkdata_list
 
-    return adjusted_chunkdata_list
 
-
-def preprocess_chunks(encode_commands, input_files, chunklist, qadjust_cycle, stored_encode_params, scd_method, scene_changes, video_length, scene_change_csv, credits_start_frame, min_chunk_length, q, credits_q,
-                      encoder, chunks_folder, rpu, qadjust_cpu, encode_script, qadjust_original_file, video_width, video_height, qadjust_b, qadjust_c, scripts_folder, decode_method, cpu, credits_cpu, qadjust_crop, qadjust_crop_values):
+def preprocess_chunks(input_files, chunklist, qadjust_cycle, stored_encode_params, scd_method, scene_changes, video_length, scene_change_csv, credits_start_frame, min_chunk_length, q, credits_q,
+                      encoder, chunks_folder, rpu, qadjust_cpu, encode_script, qadjust_original_file, video_width, video_height, qadjust_b, qadjust_c, scripts_folder, decode_method, credits_cpu, qadjust_crop, qadjust_crop_values, video_bitdepth):
     encode_params_original = stored_encode_params.copy()
-    enc_command = []
-    encode_params = []
     if qadjust_cycle < 2:
         if scd_method in (0, 1, 2, 5, 6):
             chunk_number = 1
             i = 0
-            combined = False
-            next_scene_index = None
             while i < len(scene_changes):
                 start_frame = scene_changes[i]
-                if i < len(scene_changes) - 1:
-                    end_frame = scene_changes[i + 1] - 1
+                # The chunk ends before the first scene change which makes it at least min_chunk_length long,
+                # so shorter scenes are combined into it. Scene changes are in ascending order, so a binary search finds it.
+                next_scene_index = bisect.bisect_left(scene_changes, start_frame + min_chunk_length, lo=i + 1)
+                if next_scene_index < len(scene_changes):
+                    end_frame = scene_changes[next_scene_index] - 1
                 else:
-                    end_frame = video_length - 1
+                    # No more scenes left to combine
+                    end_frame = video_length - 1  # Set end_frame based on the total video length for the last scene (Avisynth counts from 0, hence the minus one)
                 # print(i,start_frame,end_frame)
-
-                # Check if the current scene is too short
-                if end_frame - start_frame + 1 < min_chunk_length:
-                    next_scene_index = i + 2
-                    combined = True
-
-                    # Combine scenes until the chunk length is at least min_chunk_length
-                    while next_scene_index < len(scene_changes):
-                        end_frame = scene_changes[next_scene_index] - 1
-                        chunk_length = end_frame - start_frame + 1
-
-                        if chunk_length >= min_chunk_length:
-                            break  # The combined chunk is long enough
-                        else:
-                            next_scene_index += 1  # Move to the next scene
-
-                    if next_scene_index == len(scene_changes):
-                        # No more scenes left to combine
-                        end_frame = video_length - 1  # Set end_frame based on the total video length for the last scene (Avisynth counts from 0, hence the minus one)
-                    # print(f'Next scene index: {next_scene_index}')
                 chunk_length = end_frame - start_frame + 1
-                # chunk_length = 999999 if chunk_length < 0 else chunk_length
 
                 chunkdata = {
                     'chunk': chunk_number, 'length': chunk_length, 'start': start_frame, 'end': end_frame, 'credits': 0, 'q': q
@@ -685,36 +714,28 @@ def preprocess_chunks(encode_commands, input_files, chunklist, qadjust_cycle, st
                 chunklist.append(chunkdata)
 
                 chunk_number += 1
-
-                if combined:
-                    i = next_scene_index
-                    combined = False
-                else:
-                    i += 1
+                i = next_scene_index
         else:
-            with open(scene_change_csv, 'r') as pyscd_file:
-                scenelist = csv.reader(pyscd_file)
-                scenelist = list(scenelist)
-
+            with open(scene_change_csv, 'r', newline='') as pyscd_file:
                 found_start = False  # Flag to indicate when a line starting with a number is found
 
-            # Process each line in the CSV file
-            for row in scenelist:
-                if not found_start:
-                    if row and row[0].isdigit():
-                        found_start = True  # Start processing lines
-                    else:
-                        continue  # Skip lines until a line starting with a number is found
-
-                if len(row) >= 5:
-                    chunk_number = int(row[0])  # First column
-                    start_frame = int(row[1]) - 1  # Second column
-                    end_frame = int(row[4]) - 1  # Fifth column
-                    chunk_length = int(row[7])  # Eighth column
-                    chunkdata = {
-                        'chunk': chunk_number, 'length': chunk_length, 'start': start_frame, 'end': end_frame, 'credits': 0, 'q': q
-                    }
-                    chunklist.append(chunkdata)
+                # Process each line in the CSV file as it is read
+                for row in csv.reader(pyscd_file):
+                    if not found_start:
+                        if row and row[0].isdigit():
+                            found_start = True  # Start processing lines
+                        else:
+                            continue  # Skip lines until a line starting with a number is found
+
+                    if len(row) >= 8:
+                        chunk_number = int(row[0])  # First column
+                        start_frame = int(row[1]) - 1  # Second column
+                        end_frame = int(row[4]) - 1  # Fifth column
+                        chunk_length = int(row[7])  # Eighth column
+                        chunkdata = {
+                            'chunk': chunk_number, 'length': chunk_length, 'start': start_frame, 'end': end_frame, 'credits': 0, 'q': q
+                        }
+                        chunklist.append(chunkdata)
 
         if credits_start_frame:
             chunklist = adjust_chunkdata(chunklist, credits_start_frame, min_chunk_length, q, credits_q)
@@ -722,62 +743,42 @@ def preprocess_chunks(encode_commands, input_files, chunklist, qadjust_cycle, st
     if qadjust_cycle == 2:
         chunklist = sorted(chunklist, key=lambda x: x['chunk'], reverse=False)
 
-    for i in chunklist:
-        if qadjust_cycle == 1 and i['credits'] == 1:
-            continue
-        if encoder != 'x265':
-            output_chunk = os.path.join(chunks_folder, f"encoded_chunk_{i['chunk']}.ivf")
-        else:
-            output_chunk = os.path.join(chunks_folder, f"encoded_chunk_{i['chunk']}.hevc")
-        input_files.append(output_chunk)  # Add the input file for concatenation
+    # Path of an encoded chunk is the prefix, the chunk number and the extension
+    output_chunk_prefix = os.path.join(chunks_folder, "encoded_chunk_")
+    chunk_extension = 'hevc' if encoder == 'x265' else 'ivf'
+    # The scene scripts and the RPU files of a chunk are named in the same way
+    scene_script_prefix = os.path.join(scripts_folder, "scene_")
+    rpu_prefix = os.path.join(chunks_folder, "scene_")
+
+    # Add the input files for concatenation
+    input_files.extend(f"{output_chunk_prefix}{i['chunk']}.{chunk_extension}" for i in chunklist if not (qadjust_cycle == 1 and i['credits'] == 1))
 
     if qadjust_cycle != 1:
         if rpu and encoder in ('svt', 'x265'):
-            chunklist_length = len(chunklist)
             print("Splitting the RPU file based on chunks.\n")
             logging.info("Splitting the RPU file.")
-            # Use ThreadPoolExecutor for multithreading
-            with concurrent.futures.ThreadPoolExecutor(max_workers=int(os.cpu_count()/2)) as executor:
+            # Use ThreadPoolExecutor for multithreading, half of the logical processors is enough for the I/O bound dovi_tool edits
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, _CPU_COUNT // 2)) as executor:
                 # Submit each chunk to the executor
-                futures = [executor.submit(process_rpu, i, chunklist_length, video_length, scripts_folder, chunks_folder, rpu) for i in chunklist]
-                # Wait for all threads to complete
-                for future in futures:
+                futures = [executor.submit(process_rpu, i, video_length, scene_script_prefix, rpu_prefix, rpu) for i in chunklist]
+                # Collect the results as they finish so that a failed split is reported right away
+                for future in concurrent.futures.as_completed(futures):
                     future.result()
 
     chunklist = sorted(chunklist, key=lambda x: x['length'], reverse=True)
 
     if qadjust_cycle == 1:
         if encoder == 'svt':
-            replacements_list = {'--fast-decode ': '--fast-decode 1',
-                                 '--film-grain ': '--film-grain 0',
-                                 '--preset ': f'--preset {qadjust_cpu}'}
-            encode_params_original = [
-                next((replacements_list[key] for key in replacements_list if x.startswith(key)), x)
-                for x in encode_params_original
-            ]
-            if not any('--fast-decode' in param for param in encode_params_original):
-                encode_params_original.append('--fast-decode 1')
+            replacements_list = {'fast-decode': 1,
+                                 'film-grain': 0,
+                                 'preset': qadjust_cpu}
+            required_params = ('fast-decode',)
         else:
-            replacements_list = {'--preset ': '--preset fast',
-                                 '--limit-refs ': '--limit-refs 3',
-                                 '--rdoq-level ': '--rdoq-level 2',
-                                 '--rc-lookahead ': '--rc-lookahead 40',
-                                 '--lookahead-slices ': '--lookahead-slices 0',
-                                 '--b-adapt ': '--b-adapt 2'}
-            encode_params_original = [
-                next((replacements_list[key] for key in replacements_list if x.startswith(key)), x)
-                for x in encode_params_original
-            ]
-            if not any('--preset' in param for param in encode_params_original):
-                encode_params_original.append('--preset fast')
-            if not any('--rdoq-level' in param for param in encode_params_original):
-                encode_params_original.append('--rdoq-level 2')
-            if not any('--rc-lookahead' in param for param in encode_params_original):
-                encode_params_original.append('--rc-lookahead 40')
-            if not any('--lookahead-slices' in param for param in encode_params_original):
-                encode_params_original.append('--lookahead-slices 0')
-            if not any('--b-adapt' in param for param in encode_params_original):
-                encode_params_original.append('--b-adapt 2')
+            replacements_list = _X265_QADJUST_REPLACEMENTS
+            required_params = ('preset', 'rdoq-level', 'rc-lookahead', 'lookahead-slices', 'b-adapt')
+        # Replace the existing parameters and add the required ones which are missing
+        encode_params_original.update({key: value for key, value in replacements_list.items()
+                                       if encode_params_original.get(key) is not None or key in required_params})
 
         with open(encode_script, 'r') as file:
             source = file.readline()
@@ -786,163 +787,104 @@ def preprocess_chunks(encode_commands, input_files, chunklist, qadjust_cycle, st
             if qadjust_crop != '0,0,0,0':
                 qadjust_script.write(f'Crop({qadjust_crop_values[0]}, {qadjust_crop_values[1]}, -{abs(qadjust_crop_values[2])}, -{abs(qadjust_crop_values[3])})\n')
             qadjust_script.write(f'BicubicResize({video_width},{video_height},b={qadjust_b},c={qadjust_c})\n')
-    for i in chunklist:
-        if qadjust_cycle == 1 and i['credits'] == 1:
-            continue
-        encode_params = copy.deepcopy(encode_params_original)
-        if encoder in ('svt', 'x265'):
-            encode_params.append(f'--crf {i['q']}')
-        if rpu and encoder in ('svt', 'x265') and qadjust_cycle != 1:
-            rpupath = os.path.join(chunks_folder, f"scene_{i['chunk']}_rpu.bin")
-            encode_params.append(f'--dolby-vision-rpu {rpupath}')
-        scene_script_file = os.path.join(scripts_folder, f"scene_{i['chunk']}.avs")
-        if encoder != 'x265':
-            output_chunk = os.path.join(chunks_folder, f"encoded_chunk_{i['chunk']}.ivf")
+
+    # The encoder does not change between chunks, so pick its command layout and credits overrides only once
+    if encoder == 'rav1e':
+        credits_params = {'speed': credits_cpu, 'quantizer': credits_q}
+
+        def build_enc_command(params, output_chunk):
+            return ["rav1e.exe", *format_params(params, encoder), "-q", "-o", output_chunk, "-"]
+    elif encoder == 'svt':
+        credits_params = {'preset': credits_cpu, 'crf': credits_q}
+
+        def build_enc_command(params, output_chunk):
+            return ["svtav1encapp.exe", *format_params(params, encoder), "-b", output_chunk, "-i", "-"]
+    elif encoder == 'aom':
+        credits_params = {'cpu-used': credits_cpu, 'cq-level': credits_q}
+
+        def build_enc_command(params, output_chunk):
+            return ["aomenc.exe", "-q", "--ivf", *format_params(params, encoder), "--passes=1", "-o", output_chunk, "-"]
+    else:
+        credits_params = {'crf': credits_q}
+
+        def build_enc_command(params, output_chunk):
+            return ["x265.exe", "--y4m", "--no-progress", *format_params(params, encoder), "--output", output_chunk, "--input", "-"]
+    # The credits parameters are the same for every credits chunk
+    encode_params_credits = {**encode_params_original, **credits_params}
+    scene_import = f'Import("{encode_script}")\n' if qadjust_cycle != 1 else 'Import("qadjust_original.avs")\n'
+    # Workaround to aomenc bug with 8-bit input and film grain table, a 10-bit encode script needs no conversion
+    # The Q analysis scripts import qadjust_original.avs instead, whose bit depth is not the probed one, so those are always converted
+    scene_convert = 'ConvertBits(10)' if encoder != 'x265' and (qadjust_cycle == 1 or video_bitdepth != 10) else ''
+    chunk_rpu = rpu and encoder in ('svt', 'x265') and qadjust_cycle != 1
+
+    def chunk_params(i):
+        if i['credits'] == 1:
+            params = encode_params_credits.copy()
         else:
-            output_chunk = os.path.join(chunks_folder, f"encoded_chunk_{i['chunk']}.hevc")
-        # Create the Avisynth script for this scene
-        if qadjust_cycle != 1:
+            params = encode_params_original.copy()
+            if encoder in ('svt', 'x265'):
+                params['crf'] = i['q']
+        if chunk_rpu:
+            params['dolby-vision-rpu'] = f"{rpu_prefix}{i['chunk']}_rpu.bin"
+        return params
+
+    # The scene scripts and the commands are created one chunk at a time as the encoding takes them
+    def chunk_commands():
+        for i in encode_chunks:
+            chunk = i['chunk']
+            scene_script_file = f"{scene_script_prefix}{chunk}.avs"
+            output_chunk = f"{output_chunk_prefix}{chunk}.{chunk_extension}"
+            # Create the Avisynth script for this scene
             with open(scene_script_file, "w") as scene_script:
-                scene_script.write(f'Import("{encode_script}")\n')
-                scene_script.write(f"Trim({i['start']}, {i['end']})\n")
-                if encoder != 'x265':
-                    scene_script.write('ConvertBits(10)')
-        else:
-            with open(scene_script_file, 'w') as scene_script:
-                # scene_script.write(source)
-                scene_script.write(f'Import("qadjust_original.avs")\n')
-                scene_script.write(f"Trim({i['start']}, {i['end']})\n")
-                # scene_script.write(f'BicubicResize({video_width},{video_height},b={qadjust_b},c={qadjust_c})\n')
-                if encoder != 'x265':
-                    scene_script.write('ConvertBits(10)')
-        if decode_method == 0:
-            decode_command = [
-                "avs2yuv64.exe",
-                "-no-mt",
-                '"'+scene_script_file+'"',  # Use the Avisynth script for this scene
-                "-"
-            ]
-        else:
-            decode_command = [
-                "ffmpeg.exe",
-                "-loglevel", "fatal",
-                "-i", '"'+scene_script_file+'"',
-                "-f", "yuv4mpegpipe",
-                "-strict", "-1",
-                "-"
-            ]
-
-        if encoder == 'rav1e':
-            if i['credits'] == 0:
-                enc_command = [
-                    "rav1e.exe",
-                    *encode_params,
-                    "-q",
-                    "-o", '"' + output_chunk + '"',
-                    "-"
-                ]
-            else:
-                encode_params = [x.replace(f'--speed {cpu}', f'--speed {credits_cpu}').replace(f'--quantizer {q}', f'--quantizer {credits_q}') for x in encode_params]
-                enc_command = [
-                    "rav1e.exe",
-                    *encode_params,
-                    "-q",
-                    "-o", '"' + output_chunk + '"',
-                    "-"
-                ]
-        elif encoder == 'svt':
-            if i['credits'] == 0:
-                enc_command = [
-                    "svtav1encapp.exe",
-                    *encode_params,
-                    "-b", '"'+output_chunk+'"',
-                    "-i -"
-                ]
-            elif qadjust_cycle != 1:
-                encode_params = [x.replace(f'--preset {cpu}', f'--preset {credits_cpu}').replace(f'--crf {q}', f'--crf {credits_q}') for x in encode_params]
-                enc_command = [
-                    "svtav1encapp.exe",
-                    *encode_params,
-                    "-b", '"'+output_chunk+'"',
-                    "-i -"
-                ]
-        elif encoder == 'aom':
-            if i['credits'] == 0:
-                enc_command = [
-                    "aomenc.exe",
-                    "-q",
-                    "--ivf",
-                    *encode_params,
-                    "--passes=1",
-                    "-o", '"'+output_chunk+'"',
+                scene_script.write(f'{scene_import}Trim({i["start"]}, {i["end"]})\n{scene_convert}')
+            if decode_method == 0:
+                decode_command = [
+                    "avs2yuv64.exe",
+                    "-no-mt",
+                    scene_script_file,  # Use the Avisynth script for this scene
                     "-"
                 ]
             else:
-                encode_params = [x.replace(f'--cpu-used={cpu}', f'--cpu-used={credits_cpu}').replace(f'--cq-level={q}', f'--cq-level={credits_q}') for x in encode_params]
-                enc_command = [
-                    "aomenc.exe",
-                    "-q",
-                    "--ivf",
-                    *encode_params,
-                    "--passes=1",
-                    "-o", '"' + output_chunk + '"',
+                decode_command = [
+                    "ffmpeg.exe",
+                    "-loglevel", "fatal",
+                    "-i", scene_script_file,
+                    "-f", "yuv4mpegpipe",
+                    "-strict", "-1",
                     "-"
                 ]
-        else:
-            if i['credits'] == 0:
-                enc_command = [
-                    "x265.exe",
-                    "--y4m",
-                    "--no-progress",
-                    *encode_params,
-                    "--output", '"'+output_chunk+'"',
-                    "--input", "-"
-                ]
-            else:
-                encode_params = [x.replace(f'--crf {q}', f'--crf {credits_q}') for x in encode_params]
-                enc_command = [
-                    "x265.exe",
-                    "--y4m",
-                    "--no-progress",
-                    *encode_params,
-                    "--output", '"' + output_chunk + '"',
-                    "--input", "-"
-                ]
+            enc_command = build_enc_command(chunk_params(i), output_chunk)
+            # The chunk number and length travel with the command for the progress reporting
+            yield decode_command, enc_command, output_chunk, chunk, i['length']
 
-        encode_commands.append((decode_command, enc_command, output_chunk))
-    # print (encode_commands)
-    chunklist_dict = {chunk_dict['chunk']: chunk_dict['length'] for chunk_dict in chunklist}
+    encode_chunks = [i for i in chunklist if not (qadjust_cycle == 1 and i['credits'] == 1)]
+    # The parameters of the last chunk are returned for displaying
+    encode_params = chunk_params(encode_chunks[-1]) if encode_chunks else {}
     # print (chunklist)
     if qadjust_cycle != 1:
         logging.info(f"Total {len(chunklist)} chunks created.")
-    return encode_commands, input_files, chunklist, chunklist_dict, encode_params
+    return chunk_commands(), input_files, chunklist, encode_params
+
 
+def process_rpu(i, video_length, scene_script_prefix, rpu_prefix, rpu):
+    jsonpath = f"{scene_script_prefix}{i['chunk']}_rpu.json"
+    rpupath = f"{rpu_prefix}{i['chunk']}_rpu.bin"
+    split_rpu(rpu, i['start'], i['end'], video_length, jsonpath, rpupath)
 
-def process_rpu(i, chunklist_length, video_length, scripts_folder, chunks_folder, rpu):
+
+# Function to cut the RPU to the given frame range with dovi_tool, the RPU is copied as is if there is nothing to remove
+def split_rpu(rpu, start_frame, end_frame, video_length, jsonpath, rpupath):
     lastframe = video_length - 1
-    # print (chunklist)
-    jsonpath = os.path.join(scripts_folder, f"scene_{i['chunk']}_rpu.json")
-    rpupath = os.path.join(chunks_folder, f"scene_{i['chunk']}_rpu.bin")
-    if i['chunk'] == 1:
-        start = i['end'] + 1
-        data = {
-            "remove": [f"{start}-{lastframe}"]
-        }
-    elif i['chunk'] < chunklist_length:
-        start = 0
-        end = i['start'] - 1
-        start_2 = i['end'] + 1
-        data = {
-            "remove": [f"{start}-{end}", f"{start_2}-{lastframe}"]
-        }
-    else:
-        start = 0
-        end = i['start'] - 1
-        data = {
-            "remove": [f"{start}-{end}"]
-        }
+    remove = []
+    if start_frame > 0:
+        remove.append(f"0-{start_frame - 1}")
+    if end_frame < lastframe:
+        remove.append(f"{end_frame + 1}-{lastframe}")
+    if not remove:
+        shutil.copyfile(rpu, rpupath)
+        return
     with open(jsonpath, 'w') as json_file:
-        json.dump(data, json_file, indent=2)
+        json_file.write(json.dumps({"remove": remove}, separators=(',', ':')))
     dovitool_command = [
         "dovi_tool.exe",
         "editor",
@@ -950,47 +892,32 @@ def process_rpu(i, chunklist_length, video_length, scripts_folder, chunks_folder
         "-j", jsonpath,
         "-o", rpupath
     ]
-    dovitool_process = subprocess.Popen(dovitool_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    dovitool_process.communicate()
+    dovitool_process = subprocess.run(dovitool_command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
     if dovitool_process.returncode != 0:
         logging.error(f"Error in RPU processing, return code {dovitool_process.returncode}")
+        logging.error(dovitool_process.stderr.decode(errors='replace').strip())
         print("Error in RPU processing, return code:", dovitool_process.returncode)
         sys.exit(1)
 
 
-def parse_master_display(master_display, max_cll):
-    # Define conversion factors
-    conversion_factors = {'G': 0.00002, 'B': 0.00002, 'R': 0.00002, 'WP': 0.00002, 'L': 0.0001}
-
-    # Regular expression to extract values from the input string
-    pattern = re.compile(r'([A-Z]+)\((\d+),(\d+)\)')
-
-    # Function to apply the conversion factor to the extracted values
-    def convert(match):
-        group, value1, value2 = match.groups()
-        factor = conversion_factors.get(group, 1.0)
-        new_value1 = int(value1) * factor
-        new_value2 = int(value2) * factor
+# Function to apply the conversion factor to the values extracted from the master display string
+def convert_master_display(match):
+    group, value1, value2 = match.groups()
+    factor = _MASTER_DISPLAY_FACTORS.get(group, 1.0)
+    new_values = []
+    for value in (value1, value2):
+        # Round the value to three decimals, if the result is greater than 1, convert to int
+        new_value = round(int(value) * factor, 3)
+        new_values.append(int(new_value) if new_value > 1 else new_value)
 
-        # Round the values to three decimals
-        new_value1 = round(new_value1, 3)
-        new_value2 = round(new_value2, 3)
+    return f'{group}({new_values[0]},{new_values[1]})'
 
-        # If the result is greater than 1, convert to int
-        if new_value1 > 1:
-            new_value1 = int(new_value1)
-        if new_value2 > 1:
-            new_value2 = int(new_value2)
-
-        return f'{group}({new_value1},{new_value2})'
-
-    # Extract all values from the input string
-    matches = pattern.findall(master_display)
 
+def parse_master_display(master_display, max_cll):
     # Check if any of the original values is greater than 1
-    if any(int(value1) > 1 or int(value2) > 1 for group, value1, value2 in matches):
+    if any(int(value1) > 1 or int(value2) > 1 for group, value1, value2 in _MASTER_DISPLAY_RE.findall(master_display)):
         # Apply the conversion function to the input string
-        processed_string = pattern.sub(convert, master_display)
+        processed_string = _MASTER_DISPLAY_RE.sub(convert_master_display, master_display)
     else:
         processed_string = master_display
 
@@ -1002,80 +929,82 @@ def parse_master_display(master_display, max_cll):
     return processed_string, max_cll
 
 
+# Run the decoder with its output connected directly to the encoder, return the encoder return code
+def run_pipeline(decode_command, enc_command):
+    decode_process = subprocess.Popen(decode_command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        enc_process = subprocess.Popen(enc_command, stdin=decode_process.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        # Don't leave the decoder running against a pipe nobody reads
+        decode_process.kill()
+        decode_process.stdout.close()
+        decode_process.wait()
+        raise
+    # Only the encoder reads the pipe, so the decoder stops as well if the encoder exits early
+    decode_process.stdout.close()
+    with _RUNNING_PROCESSES_LOCK:
+        _RUNNING_PROCESSES.update((decode_process, enc_process))
+        if _ENCODE_ABORT.is_set():
+            decode_process.terminate()
+            enc_process.terminate()
+    enc_process.wait()
+    decode_process.wait()
+    with _RUNNING_PROCESSES_LOCK:
+        _RUNNING_PROCESSES.difference_update((decode_process, enc_process))
+    return enc_process.returncode
+
+
+# Stop the running chunk encodes and keep new ones from starting
+def stop_encodes():
+    with _RUNNING_PROCESSES_LOCK:
+        _ENCODE_ABORT.set()
+        for process in _RUNNING_PROCESSES:
+            process.terminate()
+
+
 # Function to execute encoding commands and print them for debugging
 def run_encode_command(command):
-    avs2yuv_command, enc_command, output_chunk = command
-    avs2yuv_command = " ".join(avs2yuv_command)
-    enc_command = " ".join(enc_command)
-
-    enc_command = avs2yuv_command + ' | ' + enc_command
+    decode_command, enc_command, output_chunk, *_ = command
     # logging.info(f"Launching encoding command {enc_command}")
 
     # Print the encoding command for debugging
     # print(f"\nEncoder command: {enc_command}")
 
     for attempt in range(1, 3):
+        if _ENCODE_ABORT.is_set():
+            return None
         # Execute the encoder process
-        enc_process = subprocess.Popen(enc_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        enc_process.communicate()
-        if enc_process.returncode == 0:
-            return output_chunk
+        returncode = run_pipeline(decode_command, enc_command)
+        # A pipeline terminated by stop_encodes is not an encoder failure
+        if _ENCODE_ABORT.is_set():
+            return None
+        if returncode == 0:
+            # Read the size here while the file was just written, the caller only has to do the bookkeeping
+            return output_chunk, os.path.getsize(output_chunk)
         else:
             logging.warning(f"Error in encoder processing, chunk {output_chunk}, attempt {attempt}.")
-            logging.warning(f"Return code: {enc_process.returncode}")
+            logging.warning(f"Return code: {returncode}")
             print(f"\nError in encoder processing, chunk {output_chunk}, attempt {attempt}.\n")
-            print("Return code:", enc_process.returncode)
+            print("Return code:", returncode)
 
     logging.error(f"Max retries reached, unable to encode chunk {output_chunk}.")
+    enc_command = subprocess.list2cmdline(decode_command) + ' | ' + subprocess.list2cmdline(enc_command)
     logging.error(f"The encoder command line is: {enc_command}.")
     print("Max retries reached, unable to encode chunk", output_chunk)
     print("The encoder command line is:", enc_command)
-    # sys.exit(1)
+    raise subprocess.CalledProcessError(returncode, enc_command)
 
 
-def encode_sample(output_folder, encode_script, encode_params, rpu, encoder, sample_start_frame, sample_end_frame, video_length, decode_method, threads, q):
-    start_time = datetime.now()
+def encode_sample(output_folder, encode_script, encode_params, rpu, encoder, sample_start_frame, sample_end_frame, video_length, decode_method, q, video_bitdepth):
+    start_time = time.monotonic()
+    # The sample encode uses all threads, the overrides go to a copy so that the caller's parameters stay intact
+    sample_overrides = {'rav1e': {'threads': 0}, 'svt': {'lp': 0, 'crf': q}, 'aom': {'threads': _CPU_COUNT}, 'x265': {'pools': '*', 'crf': q}}
+    encode_params = {**encode_params, **sample_overrides[encoder]}
     if rpu and encoder in ('svt', 'x265'):
         jsonpath = os.path.join(output_folder, "rpu_sample.json")
         rpupath = os.path.join(output_folder, "sample_rpu.bin")
-        encode_params.append(f'--dolby-vision-rpu {rpupath}')
-        if sample_start_frame == 0:
-            start = sample_end_frame + 1
-            end = video_length - 1
-            data = {
-                "remove": [f"{start}-{end}"]
-            }
-        elif sample_end_frame != video_length - 1:
-            start = 0
-            end = sample_start_frame - 1
-            start_2 = sample_end_frame + 1
-            end_2 = video_length - 1
-            data = {
-                "remove": [f"{start}-{end}", f"{start_2}-{end_2}"]
-            }
-        else:
-            start = 0
-            end = sample_start_frame - 1
-            data = {
-                "remove": [f"{start}-{end}"]
-            }
-
-        with open(jsonpath, 'w') as json_file:
-            json.dump(data, json_file, indent=2)
-
-        dovitool_command = [
-            "dovi_tool.exe",
-            "editor",
-            "-i", rpu,
-            "-j", jsonpath,
-            "-o", rpupath
-        ]
-        dovitool_process = subprocess.Popen(dovitool_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        dovitool_process.communicate()
-        if dovitool_process.returncode != 0:
-            logging.error(f"Error in RPU processing, return code: {dovitool_process.returncode}")
-            print("Error in RPU processing, return code:", dovitool_process.returncode)
-            sys.exit(1)
+        encode_params['dolby-vision-rpu'] = rpupath
+        split_rpu(rpu, sample_start_frame, sample_end_frame, video_length, jsonpath, rpupath)
 
     sample_script_file = os.path.join(output_folder, "sample.avs")
     if encoder != 'x265':
@@ -1086,82 +1015,71 @@ def encode_sample(output_folder, encode_script, encode_params, rpu, encoder, sam
     with open(sample_script_file, "w") as sample_script:
         sample_script.write(f'Import("{encode_script}")\n')
         sample_script.write(f"Trim({sample_start_frame}, {sample_end_frame})\n")
-        if encoder != 'x265':
+        if encoder != 'x265' and video_bitdepth != 10:
             sample_script.write('ConvertBits(10)')  # workaround to aomenc bug with 8-bit input and film grain table
 
     if decode_method == 0:
         decode_command_sample = [
             "avs2yuv64.exe",
             "-no-mt",
-            '"' + sample_script_file + '"',  # Use the Avisynth script for this scene
+            sample_script_file,  # Use the Avisynth script for this scene
             "-"
         ]
     else:
         decode_command_sample = [
             "ffmpeg.exe",
             "-loglevel", "fatal",
-            "-i", '"' + sample_script_file + '"',
+            "-i", sample_script_file,
             "-f", "yuv4mpegpipe",
             "-strict", "-1",
             "-"
         ]
 
     if encoder == 'rav1e':
-        encode_params = [x.replace(f'--threads {threads}', '--threads 0') for x in encode_params]
         enc_command_sample = [
             "rav1e.exe",
-            *encode_params,
+            *format_params(encode_params, encoder),
             "--no-scene-detection",
-            "-o", '"' + output_chunk + '"',
+            "-o", output_chunk,
             "-"
         ]
     elif encoder == 'svt':
-        encode_params = [x.replace(f'--lp {threads}', '--lp 0') for x in encode_params]
         enc_command_sample = [
             "svtav1encapp.exe",
-            *encode_params,
-            f"--crf {q}",
-            "-b", '"' + output_chunk + '"',
-            "-i -"
+            *format_params(encode_params, encoder),
+            "-b", output_chunk,
+            "-i", "-"
         ]
     elif encoder == 'aom':
-        encode_params = [x.replace(f'--threads={threads}', f'--threads={os.cpu_count()}') for x in encode_params]
         enc_command_sample = [
             "aomenc.exe",
             "--ivf",
-            *encode_params,
+            *format_params(encode_params, encoder),
             "--passes=1",
-            "-o", '"' + output_chunk + '"',
+            "-o", output_chunk,
             "-"
         ]
     else:
-        encode_params = [x.replace(f'--pools {threads}', '--pools *') for x in encode_params]
         enc_command_sample = [
             "x265.exe",
             "--y4m",
-            *encode_params,
-            f"--crf {q}",
+            *format_params(encode_params, encoder),
             "--dither",
-            "--output", '"' + output_chunk + '"',
+            "--output", output_chunk,
             "--input", "-"
         ]
 
-    decode_command_sample = ' '.join(decode_command_sample)
-    enc_command_sample = ' '.join(enc_command_sample)
-    enc_command_sample = decode_command_sample + ' | ' + enc_command_sample
-
     print("Encoding the sample file.\n")
     logging.info("Encoding the sample file.")
 
-    enc_process_sample = subprocess.Popen(enc_command_sample, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    enc_process_sample.communicate()
-    if enc_process_sample.returncode != 0:
-        logging.error(f"Error in sample encode processing, return code: {enc_process_sample.returncode}.")
-        print("Error in sample encode processing, return code:", enc_process_sample.returncode)
+    returncode = run_pipeline(decode_command_sample, enc_command_sample)
+    if returncode != 0:
+        logging.error(f"Error in sample encode processing, return code: {returncode}.")
+        print("Error in sample encode processing, return code:", returncode)
         sys.exit(1)
 
-    end_time = datetime.now()
-    sample_time = end_time - start_time
+    end_time = time.monotonic()
+    sample_time = timedelta(seconds=end_time - start_time)
     logging.info(f"Path to the sample is: {output_chunk}. Encode duration {sample_time}.")
     print("Path to the sample is:", output_chunk)
     if rpu and encoder in ('svt', 'x265'):
@@ -1173,19 +1091,8 @@ def concatenate(chunks_folder, input_files, output_final, fr, use_mkvmerge, enco
     # Create a list file for input files
     input_list_txt = os.path.join(chunks_folder, "input_list.txt")
 
-    # Write the input file list to the text file
-    with open(input_list_txt, "w") as file:
-        if use_mkvmerge:
-            for input_file in input_files:
-                file.write(f"{input_file}\n")
-        else:
-            for input_file in input_files:
-                file.write(f"file '{input_file}'\n")
-
     if use_mkvmerge:
         mkvmerge_json_file = os.path.join(chunks_folder, "input_list.json")
-        with open(input_list_txt, "r") as input_file:
-            files = [line.strip() for line in input_file]
         mkvmerge_json = [
             "--ui-language",
             "en",
@@ -1197,7 +1104,7 @@ def concatenate(chunks_folder, input_files, output_final, fr, use_mkvmerge, enco
             "0:none"
         ]
 
-        for file in files:
+        for file in input_files:
             mkvmerge_json.extend(["(", file, ")", "+"])
         mkvmerge_json.pop()  # Remove the trailing "+"
         mkvmerge_json.extend([
@@ -1206,7 +1113,7 @@ def concatenate(chunks_folder, input_files, output_final, fr, use_mkvmerge, enco
         ])
 
         with open(mkvmerge_json_file, "w") as json_file:
-            json.dump(mkvmerge_json, json_file, indent=2)
+            json.dump(mkvmerge_json, json_file, separators=(',', ':'))
 
         concat_command = [
             "mkvmerge.exe",
@@ -1218,6 +1125,10 @@ def concatenate(chunks_folder, input_files, output_final, fr, use_mkvmerge, enco
         print("Concatenating chunks using mkvmerge.\n")
 
     else:
+        # Write the input file list to the text file
+        with open(input_list_txt, "w") as file:
+            file.write(''.join(f"file '{input_file}'\n" for input_file in input_files))
+
         # Define the ffmpeg concatenation command
         if encoder != 'x265':
             concat_command = [
@@ -1255,10 +1166,10 @@ def concatenate(chunks_folder, input_files, output_final, fr, use_mkvmerge, enco
         logging.info("Concatenating using ffmpeg.")
         print("Concatenating chunks using ffmpeg.\n")
 
-    concat_process = subprocess.Popen(concat_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    concat_process.communicate()
+    concat_process = subprocess.run(concat_command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
     if concat_process.returncode != 0:
         logging.error(f"Error when concatenating, return code: {concat_process.returncode}")
+        logging.error(concat_process.stderr.decode(errors='replace').strip())
         print("Error when concatenating, return code:", concat_process.returncode)
         sys.exit(1)
 
@@ -1266,6 +1177,27 @@ def concatenate(chunks_folder, input_files, output_final, fr, use_mkvmerge, enco
     print(f"Concatenated video saved as {output_final}.")
 
 
+# Function to collect the default encoder values from the commandline parameters
+def build_default_values(encoder, cpu, q, threads, keyint, master_display, max_cll, video_transfer):
+    if encoder == 'rav1e':
+        default_values = {"speed": cpu, "quantizer": q, "keyint": keyint, "threads": threads}
+    elif encoder == 'svt':
+        default_values = {"preset": cpu, "lp": threads}
+    elif encoder == 'x265':
+        default_values = {"log-level": -1, "pools": threads, "min-keyint": keyint, "keyint": keyint}
+    else:
+        default_values = {"cpu-used": cpu, "cq-level": q, "threads": threads, "kf-max-dist": keyint, "chroma-q-offset-u": -q + 2, "chroma-q-offset-v": -q + 2}
+    if master_display and encoder in _HDR_PARAM_NAMES:
+        master_display_key, max_cll_key = _HDR_PARAM_NAMES[encoder]
+        default_values[master_display_key] = master_display
+        default_values[max_cll_key] = max_cll
+        if encoder == 'svt':
+            default_values.update({'enable-hdr': 1, 'chroma-sample-position': 2})
+    if encoder == 'x265' and video_transfer == 'smpte2084':
+        default_values.update(_X265_HDR10_PARAMS)
+    return default_values
+
+
 def read_presets(presets, encoder):
     scriptdir = os.path.dirname(os.path.realpath(__file__))
     presetpath = os.path.join(scriptdir, 'presets.ini')
@@ -1311,49 +1243,68 @@ def calculate_standard_deviation(score_list: list[int]):
     return average, sorted_score_list[len(filtered_score_list) // 20]
 
 
-def run_encode(qadjust_cycle, chunklist, video_length, fr, max_parallel_encodes, encode_commands, chunklist_dict, start_time):
+def run_encode(qadjust_cycle, chunklist, video_length, fr, executor, max_parallel_encodes, encode_commands, start_time):
     completed_chunks = []  # List of completed chunks
     processed_length = 0
     total_filesize_kbits = 0.0
+    avg_bitrate = '0'
     if qadjust_cycle == 1:
-        video_length_qadjust = 0
-        for i in chunklist:
-            if i['credits'] == 1:
-                continue
-            else:
-                video_length_qadjust += i['length']
-        progress_bar = tqdm(total=video_length_qadjust, desc="Progress", unit="frames", smoothing=0)
+        video_length_qadjust = sum(i['length'] for i in chunklist if i['credits'] != 1)
+        progress_bar = tqdm(total=video_length_qadjust, desc="Progress", unit="frames", smoothing=0, mininterval=0.25)
     else:
-        progress_bar = tqdm(total=video_length, desc="Progress", unit="frames", smoothing=0)
-    with concurrent.futures.ThreadPoolExecutor(max_parallel_encodes) as executor:
-        futures = {executor.submit(run_encode_command, cmd): cmd for cmd in encode_commands}
-        try:
-            for future in concurrent.futures.as_completed(futures):
-                output_chunk = future.result()
-                parts = output_chunk.split('_')
-                chunk_number = int(str(parts[-1].split('.')[0]))
-                chunk_length = chunklist_dict.get(chunk_number) / fr
-                chunk_size = os.path.getsize(output_chunk) / 1024 * 8
-                processed_length = processed_length + chunk_length
-                chunk_avg_bitrate = round(chunk_size / chunk_length, 2)
-                total_filesize_kbits = total_filesize_kbits + chunk_size
+        progress_bar = tqdm(total=video_length, desc="Progress", unit="frames", smoothing=0, mininterval=0.25)
+    _ENCODE_ABORT.clear()
+    # The executor is shared by all encoding phases, so the worker threads are not recreated for every run.
+    # Only a small backlog of chunks is submitted at a time, the next one is submitted whenever a chunk finishes.
+    pending_commands = iter(encode_commands)
+    futures = {}
+
+    def submit_next():
+        cmd = next(pending_commands, None)
+        if cmd is not None:
+            futures[executor.submit(run_encode_command, cmd)] = cmd
+
+    try:
+        for _ in range(max_parallel_encodes * 2):
+            submit_next()
+        while futures:
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                cmd = futures.pop(future)
+                output_chunk, output_chunk_size = future.result()
+                submit_next()
+                chunk_number, chunk_frames = cmd[3:]
+                chunk_length = chunk_frames / fr
+                chunk_size = output_chunk_size / 1024 * 8
+                # Running totals for the average bitrate of the finished chunks
+                processed_length += chunk_length
+                total_filesize_kbits += chunk_size
                 avg_bitrate = str(round(total_filesize_kbits / processed_length, 2))
                 if qadjust_cycle != 3:
-                    logging.info(f"Chunk {chunk_number} finished, length {round(chunk_length, 2)}s, average bitrate {chunk_avg_bitrate} kbps.")
-                progress_bar.update(chunklist_dict.get(chunk_number))
-                progress_bar.set_postfix({'Rate': avg_bitrate})
+                    logging.info(f"Chunk {chunk_number} finished, length {round(chunk_length, 2)}s, average bitrate {round(chunk_size / chunk_length, 2)} kbps.")
+                # The postfix is drawn by the update, which skips redrawing more often than mininterval
+                progress_bar.set_postfix({'Rate': avg_bitrate}, refresh=False)
+                progress_bar.update(chunk_frames)
                 completed_chunks.append(output_chunk)
                 # print(f"Encoding for scene completed: {output_chunk}")
-        except Exception as e:
-            logging.error("Something went wrong while encoding, please restart!")
-            logging.error(f"Exception: {e}")
-            print("Something went wrong while encoding, please restart!\n")
-            print("Exception:", e)
+    except (subprocess.CalledProcessError, OSError) as e:
+        logging.error("Something went wrong while encoding, please restart!")
+        logging.error(f"Exception: {e}")
+        print("Something went wrong while encoding, please restart!\n")
+        print("Exception:", e)
+        # Drop the chunks that have not started and stop the running ones instead of letting them finish for nothing
+        for future in futures:
+            future.cancel()
+        stop_encodes()
+        concurrent.futures.wait(futures)
+        progress_bar.close()
+        # The chunks of this phase are incomplete, so there is nothing valid to concatenate
+        sys.exit(1)
 
     # Wait for all encoding processes to finish before concatenating
     progress_bar.close()
-    end_time = datetime.now()
-    encoding_time = end_time - start_time
+    # start_time is a time.monotonic() reading, unaffected by clock adjustments during long encodes
+    encoding_time = timedelta(seconds=time.monotonic() - start_time)
     if qadjust_cycle != 1:
         print("Finished encoding the chunks.\n")
         logging.info(f"Final encode finished, average bitrate {avg_bitrate} kbps.")
@@ -1382,10 +1333,10 @@ def calculate_ssimu2(chunklist, skip, qadjust_cycle, qadjust_original_file, outp
     chunklist = sorted(chunklist, key=lambda x: x['chunk'], reverse=False)
     print(f"Calculating the SSIMU2 score using skip value {skip}.\n")
     logging.info(f"Calculating the SSIMU2 score, using skip value {skip}.")
-    start_time = datetime.now()
+    start_time = time.monotonic()
     pbar_median_sum = 0
 
-    progress_bar = tqdm(total=len(chunklist), desc="Progress", unit="chunk", smoothing=0)
+    progress_bar = tqdm(total=len(chunklist), desc="Progress", unit="chunk", smoothing=0, mininterval=0.25)
 
     for i in range(len(chunklist)):
         if chunklist[i]['credits'] == 1:
@@ -1411,8 +1362,8 @@ def calculate_ssimu2(chunklist, skip, qadjust_cycle, qadjust_original_file, outp
         percentile_5_total.append(percentile_5)
         if qadjust_verify and qadjust_cycle == 1:
             percentile_5_total_firstpass.append(percentile_5)
+        progress_bar.set_postfix({'Median score': pbar_median}, refresh=False)
         progress_bar.update(1)
-        progress_bar.set_postfix({'Median score': pbar_median})
 
     progress_bar.close()
     (average, percentile_5) = calculate_standard_deviation(total_ssim_scores)
@@ -1470,14 +1421,27 @@ def calculate_ssimu2(chunklist, skip, qadjust_cycle, qadjust_original_file, outp
     else:
         with open(qadjust_final_results_file, 'w') as results_file:
             json.dump(qadjust_final_data, results_file, indent=4)
-    end_time = datetime.now()
-    ssimu_time = end_time - start_time
+    end_time = time.monotonic()
+    ssimu_time = timedelta(seconds=end_time - start_time)
     logging.info(f"SSIMU2 calculation finished, duration {ssimu_time}.")
     if qadjust_cycle == 1:
         chunklist = sorted(chunklist, key=lambda x: x['length'], reverse=True)
         return chunklist, average_firstpass
 
 
+# Look up the executables from the current folder and PATH in one pass, missing ones are None
+def find_executables(names):
+    search_dirs = [d for d in os.environ.get('PATH', '').split(os.pathsep) if d]
+    if os.name == 'nt':
+        search_dirs.insert(0, os.getcwd())
+    found = dict.fromkeys(names)
+    for d in search_dirs:
+        for name in names:
+            if found[name] is None and os.path.isfile(os.path.join(d, name)):
+                found[name] = os.path.join(d, name)
+    return found
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('encode_script')
@@ -1559,7 +1523,7 @@ def main():
     extracl_dict = {}
     dovicl_dict = {}
 
-    start_time_total = datetime.now()
+    start_time_total = time.monotonic()
 
     # Sanity checks of parameters, thanks to Python argparse being stupid if the allowed range is big
     if encode_script is None:
@@ -1568,57 +1532,37 @@ def main():
     elif encoder not in ('rav1e', 'svt', 'aom', 'x265'):
         print("Valid encoder choices are rav1e, svt, aom or x265.\n")
         sys.exit(1)
-    elif encoder in ('svt', 'aom', 'x265') and 2 > q > 64:
-        print("Q must be 2-64.\n")
-        sys.exit(1)
-    elif encoder == 'rav1e' and 0 > q > 255:
-        print("Q must be 0-255.\n")
-        sys.exit(1)
-    elif -1 > cpu > 12:
-        print("CPU must be -1..12.\n")
-        sys.exit(1)
-    elif threads and 1 > threads > 64:
-        print("Threads must be 1-64.\n")
-        sys.exit(1)
-    elif 5 > min_chunk_length > 999999:
-        print("Minimum chunk length must be 5-999999.\n")
-        sys.exit(1)
-    elif 1 > max_parallel_encodes > 64:
-        print("Maximum parallel encodes is 1-64.\n")
-        sys.exit(1)
-    elif graintable_method and graintable_method not in (0, 1):
+
+    # The allowed ranges of the numeric parameters, the parameters which are not set are not checked
+    q_low, q_high = (0, 255) if encoder == 'rav1e' else (2, 64)
+    range_checks = [
+        (q, q_low, q_high, f"Q must be {q_low}-{q_high}."),
+        (cpu, -1, 12, "CPU must be -1..12."),
+        (threads, 1, 64, "Threads must be 1-64."),
+        (min_chunk_length, 5, 999999, "Minimum chunk length must be 5-999999."),
+        (max_parallel_encodes, 1, 64, "Maximum parallel encodes is 1-64."),
+        (graintable_sat, 0, 1, "Graintable saturation must be 0-1.0."),
+        (scd_method, 0, 6, "Scene change detection method must be 0-6."),
+        (scdthresh, 0, 10, "Scene change detection threshold must be 0-10.0."),
+        (downscale_scd, 0, 8, "Scene change detection downscale factor must be 0-8."),
+        (credits_q if encoder != 'x265' else None, q_low, q_high, f"Q for credits must be {q_low}-{q_high}."),
+        (credits_cpu, -1, 12, "CPU for credits must be -1..12."),
+        (graintable_cpu if graintable else None, -1, 12, "CPU for FGS analysis must be -1..12."),
+    ]
+    for value, low, high, message in range_checks:
+        if value is not None and not low <= value <= high:
+            print(f"{message}\n")
+            sys.exit(1)
+
+    if graintable_method and graintable_method not in (0, 1):
         print("Graintable method must be 0 or 1.\n")
         sys.exit(1)
-    elif graintable_sat and 0 > graintable_sat > 1:
-        print("Graintable saturation must be 0-1.0.\n")
-        sys.exit(1)
-    elif 0 > scd_method > 6:
-        print("Scene change detection method must be 0-6.\n")
-        sys.exit(1)
     elif scd_tonemap and scd_tonemap not in (0, 1):
         print("Scene change detection tonemap must be 0 or 1.\n")
         sys.exit(1)
-    elif scdthresh and 1 > scdthresh > 10:
-        print("Scene change detection threshold must be 1-10.0.\n")
-        sys.exit(1)
-    elif 0 > downscale_scd > 8:
-        print("Scene change detection downscale factor must be 0-8.\n")
-        sys.exit(1)
     elif decode_method and decode_method not in (0, 1):
         print("Decoding method must be 0 or 1.\n")
         sys.exit(1)
-    elif credits_q and encoder in ('svt', 'aom') and 2 > credits_q > 64:
-        print("Q for credits must be 2-64.\n")
-        sys.exit(1)
-    elif credits_q and encoder == 'rav1e' and 0 > credits_q > 255:
-        print("Q for credits must be 0-255.\n")
-        sys.exit(1)
-    elif credits_cpu and -1 > credits_cpu > 12:
-        print("CPU for credits must be -1..11.\n")
-        sys.exit(1)
-    elif graintable and graintable_cpu and -1 > graintable_cpu > 12:
-        print("CPU for FGS analysis must be -1..11.\n")
-        sys.exit(1)
     elif qadjust_crop != '0,0,0,0':
         qadjust_crop_values = [int(x) for x in qadjust_crop.split(',')]
         if len(qadjust_crop_values) != 4 or not (qadjust_crop_values[0] >= 0 and qadjust_crop_values[1] >= 0):
@@ -1626,44 +1570,13 @@ def main():
             print("The first two values must be positive or zero, the last two can be zero, positive or negative (consult Avisynth's Crop function for more details).\n")
             sys.exit(1)
 
-    # Check that needed executables can be found
-    if shutil.which("ffmpeg.exe") is None:
-        print("Unable to find ffmpeg.exe from PATH, exiting..\n")
-        sys.exit(1)
-    if encoder == 'rav1e':
-        if shutil.which("rav1e.exe") is None:
-            print("Unable to find rav1e.exe from PATH, exiting..\n")
-            sys.exit(1)
-    elif encoder == 'aom':
-        if shutil.which("aomenc.exe") is None:
-            print("Unable to find aomenc.exe from PATH, exiting..\n")
-            sys.exit(1)
-    elif encoder == 'svt':
-        if shutil.which("svtav1encapp.exe") is None:
-            print("Unable to find svtav1encapp.exe from PATH, exiting..\n")
-            sys.exit(1)
-    else:
-        if shutil.which("x265.exe") is None:
-            print("Unable to find x265.exe from PATH, exiting..\n")
-            sys.exit(1)
-    if decode_method == 1:
-        if shutil.which("avs2yuv64.exe") is None:
-            print("Unable to find avs2yuv64.exe from PATH, exiting..\n")
-            sys.exit(1)
-    if scd_method in (3, 4):
-        if shutil.which("scenedetect.exe") is None:
-            print("Unable to find scenedetect.exe from PATH, exiting..\n")
-            sys.exit(1)
-    if graintable_method == 1 or create_graintable:
-        if shutil.which("grav1synth.exe") is None:
-            print("Unable to find grav1synth.exe from PATH, exiting..\n")
-            sys.exit(1)
-
     # Store the full path of encode_script
     encode_script = os.path.abspath(encode_script)
 
     # Get video props from the source
-    video_width, video_height, video_length, video_transfer, video_matrix, video_framerate, fr = get_video_props(encode_script)
+    video_width, video_height, video_length, video_transfer, video_matrix, video_framerate, fr, video_bitdepth = get_video_props(encode_script)
+    # Maximum keyframe interval of ten seconds
+    keyint = video_framerate * 10
 
     if credits_start_frame and credits_start_frame >= video_length - 1:
         print("The credits cannot start at or after the end of video.\n")
@@ -1721,13 +1634,6 @@ def main():
             max_cll = "0,0"
         if encoder != 'x265':
             master_display, max_cll = parse_master_display(master_display, max_cll)
-    if shutil.which("mkvmerge.exe") is not None:
-        use_mkvmerge = True
-    else:
-        use_mkvmerge = False
-    if rpu and use_mkvmerge is False:
-        print("Dolby Vision mode cannot be used if mkvmerge is not available, exiting..\n")
-        sys.exit(1)
     if qadjust:
         qadjust_cycle = 1
         if encoder not in ('svt', 'x265'):
@@ -1741,53 +1647,7 @@ def main():
         br = 2
 
     # Collect default values from commandline parameters
-    if encoder == 'rav1e':
-        default_values = {
-            "speed": cpu,
-            "quantizer": q,
-            "keyint": video_framerate * 10,
-            "threads": threads,
-        }
-        if master_display:
-            default_values['mastering-display'] = '"' + master_display + '"'
-            default_values['content-light'] = max_cll
-    elif encoder == 'svt':
-        default_values = {
-            "preset": cpu,
-            "lp": threads,
-        }
-        if master_display:
-            default_values['mastering-display'] = '"' + master_display + '"'
-            default_values['content-light'] = max_cll
-            default_values['enable-hdr'] = 1
-            default_values['chroma-sample-position'] = 2
-    elif encoder == 'x265':
-        default_values = {
-            "log-level": -1,
-            "pools": threads,
-            "min-keyint": video_framerate * 10,
-            "keyint": video_framerate * 10,
-        }
-        if master_display:
-            default_values['master-display'] = '"' + master_display + '"'
-            default_values['max-cll'] = '"' + max_cll + '"'
-        if video_transfer == 'smpte2084':
-            default_values['colorprim'] = 9
-            default_values['transfer'] = 16
-            default_values['colormatrix'] = 9
-            default_values['chromaloc'] = 2
-            default_values['hdr10'] = ""
-            default_values['hdr10-opt'] = ""
-            default_values['repeat-headers'] = ""
-    else:
-        default_values = {
-            "cpu-used": cpu,
-            "cq-level": q,
-            "threads": threads,
-            "kf-max-dist": video_framerate * 10,
-            "chroma-q-offset-u": -q + 2,
-            "chroma-q-offset-v": -q + 2,
-        }
+    default_values = build_default_values(encoder, cpu, q, threads, keyint, master_display, max_cll, video_transfer)
 
     default_params, preset_params, base_working_folder = read_presets(presets, encoder)
     encode_params = {**default_values, **default_params, **preset_params}
@@ -1796,22 +1656,7 @@ def main():
         print("Dolby Vision mode detected, please note that it is experimental.\n")
     elif rpu and encoder == 'x265':
         print("Dolby Vision mode detected, VBV enabled and Level 5.1 set.\n")
-        dovicl = "--level-idc 5.1 --dolby-vision-profile 8.1 --vbv-bufsize 160000 --vbv-maxrate 160000"
-        dovicl = shlex.split(dovicl)
-        i = 0
-        while i < len(dovicl):
-            arg = dovicl[i]
-            if arg.startswith('--'):
-                key = arg[2:]
-                if i + 1 < len(dovicl) and not dovicl[i + 1].startswith('--'):
-                    value = dovicl[i + 1]
-                    dovicl_dict[key] = value
-                    i += 2
-                else:
-                    dovicl_dict[key] = ''
-                    i += 1
-            else:
-                i += 1
+        dovicl_dict = {'level-idc': '5.1', 'dolby-vision-profile': '8.1', 'vbv-bufsize': '160000', 'vbv-maxrate': '160000'}
         encode_params.update(dovicl_dict)
 
     if extracl:
@@ -1835,12 +1680,6 @@ def main():
                 i += 1
         encode_params.update(extracl_dict)
 
-    # Create a list of non-empty parameters in the encoder supported format
-    if encoder in ('svt', 'rav1e', 'x265'):
-        encode_params = [f"--{key} {value}" for key, value in encode_params.items() if value is not None]
-    else:
-        encode_params = [f"--{key}={value}" for key, value in encode_params.items() if value is not None]
-
     if listparams:
         print("\nYour working folder:", base_working_folder)
         print("\nThe default values from the Chunk Norris script:\n")
@@ -1861,20 +1700,37 @@ def main():
             for key, value in dovicl_dict.items():
                 print(key, value)
         print("\nAll encoding parameters combined:\n")
-        encode_params = " ".join(encode_params)
-        encode_params = encode_params.replace('  ', ' ')
-        print(encode_params)
+        print(display_params(encode_params, encoder))
         sys.exit(0)
 
-    # Determine the output folder name based on the encode_script
-    output_folder_name = os.path.splitext(os.path.basename(encode_script))[0]
-    output_folder_name = os.path.join(base_working_folder, output_folder_name)
+    # Check that needed executables can be found, the encoder and the grain table method are final by now
+    encoder_executables = {'rav1e': "rav1e.exe", 'aom': "aomenc.exe", 'svt': "svtav1encapp.exe", 'x265': "x265.exe"}
+    required_executables = ["ffmpeg.exe", encoder_executables[encoder]]
+    if decode_method == 0:
+        required_executables.append("avs2yuv64.exe")
+    if scd_method in (3, 4):
+        required_executables.append("scenedetect.exe")
+    if graintable_method == 1 or create_graintable:
+        required_executables.append("grav1synth.exe")
+    executables = find_executables(required_executables + ["mkvmerge.exe"])
+    for executable in required_executables:
+        if executables[executable] is None:
+            print(f"Unable to find {executable} from PATH, exiting..\n")
+            sys.exit(1)
+
+    use_mkvmerge = executables["mkvmerge.exe"] is not None
+    if rpu and use_mkvmerge is False:
+        print("Dolby Vision mode cannot be used if mkvmerge is not available, exiting..\n")
+        sys.exit(1)
+
+    # Determine the output folder name and the base filename based on the encode_script
+    output_name = os.path.splitext(os.path.basename(encode_script))[0]
+    output_folder_name = os.path.join(base_working_folder, output_name)
 
     # Naming for the Avisynth scripts, encoded chunks, and output folders and base filename
     output_folder = os.path.join(output_folder_name, "output")
     scripts_folder = os.path.join(output_folder_name, "scripts")
     chunks_folder = os.path.join(output_folder_name, "chunks")
-    output_name = os.path.splitext(os.path.basename(encode_script))[0]
 
     # Define final video file name
     if encoder != 'x265':
@@ -1926,13 +1782,13 @@ def main():
         output_grain_table_baseline = os.path.join(output_grain_table, f"{output_name}_grain_baseline.tbl")
         output_grain_table = os.path.join(output_grain_table, f"{output_name}_grain.tbl")
 
-        start_time = datetime.now()
+        start_time = time.monotonic()
         if create_graintable:
             try:
-                create_fgs_table(encode_params, output_grain_table, scripts_folder, video_width, encode_script, graintable_sat, decode_method, encoder, threads, cpu, graintable_cpu, output_grain_file_encoded, output_grain_file_lossless,
+                create_fgs_table(encode_params, output_grain_table, scripts_folder, video_width, encode_script, graintable_sat, decode_method, encoder, graintable_cpu, output_grain_file_encoded, output_grain_file_lossless,
                                  output_grain_table_baseline)
-                end_time = datetime.now()
-                graintable_time = end_time - start_time
+                end_time = time.monotonic()
+                graintable_time = timedelta(seconds=end_time - start_time)
                 logging.info(f"Graintable created, path {output_grain_table}. Duration {graintable_time}.")
                 print("Graintable created successfully, the path is:", output_grain_table)
             except Exception as e:
@@ -1941,122 +1797,100 @@ def main():
                 sys.exit(1)
             sys.exit(0)
         # Create the reference files for FGS
-        if encoder == 'svt':
-            if graintable_method > 0:
-                create_fgs_table(encode_params, output_grain_table, scripts_folder, video_width, encode_script, graintable_sat, decode_method, encoder, threads, cpu, graintable_cpu, output_grain_file_encoded, output_grain_file_lossless,
-                                 output_grain_table_baseline)
-                end_time = datetime.now()
-                graintable_time = end_time - start_time
-                logging.info(f"Graintable created, path {output_grain_table}. Duration {graintable_time}.")
-                if qadjust_cycle != 1:
-                    encode_params.append(f"--fgs-table \"{output_grain_table}\"")
-            elif graintable:
-                if qadjust_cycle != 1:
-                    encode_params.append(f"--fgs-table \"{graintable}\"")
-        elif encoder == 'rav1e':
-            if graintable_method > 0:
-                create_fgs_table(encode_params, output_grain_table, scripts_folder, video_width, encode_script, graintable_sat, decode_method, encoder, threads, cpu, graintable_cpu, output_grain_file_encoded, output_grain_file_lossless,
-                                 output_grain_table_baseline)
-                end_time = datetime.now()
-                graintable_time = end_time - start_time
-                logging.info(f"Graintable created, path {output_grain_table}. Duration {graintable_time}.")
-                encode_params.append(f"--film-grain-table \"{output_grain_table}\"")
-            elif graintable:
-                encode_params.append(f"--film-grain-table \"{graintable}\"")
-        else:
-            if graintable_method > 0:
-                create_fgs_table(encode_params, output_grain_table, scripts_folder, video_width, encode_script, graintable_sat, decode_method, encoder, threads, cpu, graintable_cpu, output_grain_file_encoded, output_grain_file_lossless,
-                                 output_grain_table_baseline)
-                end_time = datetime.now()
-                graintable_time = end_time - start_time
-                logging.info(f"Graintable created, path {output_grain_table}. Duration {graintable_time}.")
-                encode_params.append(f"--film-grain-table=\"{output_grain_table}\"")
-            elif graintable:
-                encode_params.append(f"--film-grain-table=\"{graintable}\"")
+        if graintable_method > 0:
+            create_fgs_table(encode_params, output_grain_table, scripts_folder, video_width, encode_script, graintable_sat, decode_method, encoder, graintable_cpu, output_grain_file_encoded, output_grain_file_lossless,
+                             output_grain_table_baseline)
+            end_time = time.monotonic()
+            graintable_time = timedelta(seconds=end_time - start_time)
+            logging.info(f"Graintable created, path {output_grain_table}. Duration {graintable_time}.")
+            graintable = output_grain_table
+        # SVT-AV1 leaves the grain out of the Q analysis encode
+        if graintable and not (encoder == 'svt' and qadjust_cycle == 1):
+            encode_params[_FGS_TABLE_PARAM[encoder]] = graintable
 
     # Encode only the sample if start and end frames are supplied, exit afterwards.
     if sample_start_frame is not None and sample_end_frame is not None:
-        encode_sample(output_folder, encode_script, encode_params, rpu, encoder, sample_start_frame, sample_end_frame, video_length, decode_method, threads, q)
+        encode_sample(output_folder, encode_script, encode_params, rpu, encoder, sample_start_frame, sample_end_frame, video_length, decode_method, q, video_bitdepth)
         sys.exit(0)
 
     # Detect scene changes
-    scd_script = os.path.splitext(os.path.basename(encode_script))[0] + "_scd.avs"
-    scd_script = os.path.join(os.path.dirname(encode_script), scd_script)
-    scene_change_csv = os.path.join(output_folder_name, f"scene_changes_{os.path.splitext(os.path.basename(encode_script))[0]}.csv")
+    scd_script = os.path.join(os.path.dirname(encode_script), f"{output_name}_scd.avs")
+    scene_change_csv = os.path.join(output_folder_name, f"scene_changes_{output_name}.csv")
+    # The working folder of the script is cleaned on every run, so the stored scene changes are kept one level up
+    scd_cache_file = os.path.join(base_working_folder, f"{output_name}.scd.json")
     if scd_method in (5, 6):
         create_scxvid_file(scene_change_csv, scd_method, scd_tonemap, encode_script, cudasynth, downscale_scd, scd_script, scene_change_file_path)
-    scene_changes = scene_change_detection(scd_script, scd_method, scdthresh, encode_script, scd_tonemap, cudasynth, downscale_scd, scene_change_csv, output_folder_name, min_chunk_length)
+    scene_changes = scene_change_detection(scd_script, scd_method, scdthresh, encode_script, scd_tonemap, cudasynth, downscale_scd, scene_change_csv, output_folder_name, min_chunk_length,
+                                           scd_cache_file, video_length)
     logging.info("Finished processing the scene change data.")
 
     # Create the AVS scripts, prepare encoding and concatenation commands for chunks
-    encode_commands = []  # List to store the encoding commands
     input_files = []  # List to store input files for concatenation
     chunklist = []  # Helper list for producing the encoding and concatenation lists
     qadjust_original_file = os.path.join(scripts_folder, f"qadjust_original.avs")
 
     # Run encoding commands with a set maximum of concurrent processes
     stored_encode_params = encode_params.copy()
-    encode_commands, input_files, chunklist, chunklist_dict, encode_params = preprocess_chunks(encode_commands, input_files, chunklist, qadjust_cycle, stored_encode_params, scd_method, scene_changes, video_length, scene_change_csv,
-                                                                                               credits_start_frame, min_chunk_length, q, credits_q, encoder, chunks_folder, rpu, qadjust_cpu, encode_script, qadjust_original_file,
-                                                                                               video_width, video_height, qadjust_b, qadjust_c, scripts_folder, decode_method, cpu, credits_cpu, qadjust_crop, qadjust_crop_values)
-    encode_params_displist = " ".join(encode_params)
-    encode_params_displist = encode_params_displist.replace('  ', ' ')
-
-    start_time = datetime.now()
-    if qadjust is True:
-        output_final_ssimu2 = os.path.join(output_folder, f"{output_name}_ssimu2.mkv")
-        percentile_5_total_firstpass = []
-        if not qadjust_skip:
-            if (video_width * video_height) >= 1520640:
-                qadjust_skip = 2
-            else:
-                qadjust_skip = 1
-        if reuse_qadjust is True:
-            reused_q_values = [chunk['adjusted_Q'] for chunk in qadjust_firstpass_data['chunks']]
-            reused_percentile_values = [chunk['percentile_5th'] for chunk in qadjust_firstpass_data['chunks']]
-            chunklist = sorted(chunklist, key=lambda x: x['chunk'], reverse=False)
-            if credits_start_frame:
-                qadjust_chunks = len(chunklist) - 1
+    encode_commands, input_files, chunklist, encode_params = preprocess_chunks(input_files, chunklist, qadjust_cycle, stored_encode_params, scd_method, scene_changes, video_length, scene_change_csv,
+                                                                               credits_start_frame, min_chunk_length, q, credits_q, encoder, chunks_folder, rpu, qadjust_cpu, encode_script, qadjust_original_file,
+                                                                               video_width, video_height, qadjust_b, qadjust_c, scripts_folder, decode_method, credits_cpu, qadjust_crop, qadjust_crop_values, video_bitdepth)
+    encode_params_displist = display_params(encode_params, encoder)
+
+    # One pool of encoder worker threads is kept for all encoding phases (Q analysis and final encode)
+    with concurrent.futures.ThreadPoolExecutor(max_parallel_encodes) as executor:
+        # Final encode of the chunks and the concatenation, shared by the normal and the qadjust paths
+        def final_encode(chunklist, encode_commands, input_files, encode_params_displist, start_time):
+            print("The encoder parameters for the final encode:", encode_params_displist)
+            print("\n")
+            run_encode(qadjust_cycle, chunklist, video_length, fr, executor, max_parallel_encodes, encode_commands, start_time)
+            concatenate(chunks_folder, input_files, output_final, fr, use_mkvmerge, encoder)
+
+        start_time = time.monotonic()
+        if qadjust is True:
+            output_final_ssimu2 = os.path.join(output_folder, f"{output_name}_ssimu2.mkv")
+            percentile_5_total_firstpass = []
+            if not qadjust_skip:
+                if (video_width * video_height) >= 1520640:
+                    qadjust_skip = 2
+                else:
+                    qadjust_skip = 1
+            if reuse_qadjust is True:
+                reused_q_values = [chunk['adjusted_Q'] for chunk in qadjust_firstpass_data['chunks']]
+                reused_percentile_values = [chunk['percentile_5th'] for chunk in qadjust_firstpass_data['chunks']]
+                chunklist = sorted(chunklist, key=lambda x: x['chunk'], reverse=False)
+                if credits_start_frame:
+                    qadjust_chunks = len(chunklist) - 1
+                else:
+                    qadjust_chunks = len(chunklist)
+                for i in range(qadjust_chunks):
+                    chunklist[i]['q'] = reused_q_values[i]
+                    percentile_5_total_firstpass.append(reused_percentile_values[i])
+                chunklist = sorted(chunklist, key=lambda x: x['length'], reverse=True)
             else:
-                qadjust_chunks = len(chunklist)
-            for i in range(qadjust_chunks):
-                chunklist[i]['q'] = reused_q_values[i]
-                percentile_5_total_firstpass.append(reused_percentile_values[i])
-            chunklist = sorted(chunklist, key=lambda x: x['length'], reverse=True)
+                logging.info("Set up chunklist and corresponding encode commands for the Q adjust phase.")
+                print("The encoder parameters for the analysis:", encode_params_displist)
+                print("\n")
+                run_encode(qadjust_cycle, chunklist, video_length, fr, executor, max_parallel_encodes, encode_commands, start_time)
+                concatenate(chunks_folder, input_files, output_final_ssimu2, fr, use_mkvmerge, encoder)
+                chunklist, average_firstpass = calculate_ssimu2(chunklist, qadjust_skip, qadjust_cycle, qadjust_original_file, output_final_ssimu2, encode_script, output_final, video_matrix, qadjust_verify, percentile_5_total_firstpass,
+                                                                encoder, q, br, qadjust_results_file, qadjust_final_results_file, qadjust_firstpass_data, qadjust_final_data, average_firstpass)
+            qadjust_cycle = 2
+            clean_files(chunks_folder, 'encoded')
+            input_files = []
+            encode_commands, input_files, chunklist, encode_params = preprocess_chunks(input_files, chunklist, qadjust_cycle, stored_encode_params, scd_method, scene_changes, video_length, scene_change_csv,
+                                                                                       credits_start_frame, min_chunk_length, q, credits_q, encoder, chunks_folder, rpu, qadjust_cpu, encode_script, qadjust_original_file,
+                                                                                       video_width, video_height, qadjust_b, qadjust_c, scripts_folder, decode_method, credits_cpu, qadjust_crop, qadjust_crop_values, video_bitdepth)
+            encode_params_displist = display_params(encode_params, encoder)
+            final_encode(chunklist, encode_commands, input_files, encode_params_displist, time.monotonic())
+            if qadjust_verify:
+                calculate_ssimu2(chunklist, qadjust_skip, qadjust_cycle, qadjust_original_file, output_final_ssimu2, encode_script, output_final, video_matrix, qadjust_verify, percentile_5_total_firstpass, encoder, q, br,
+                                 qadjust_results_file, qadjust_final_results_file, qadjust_firstpass_data, qadjust_final_data, average_firstpass)
         else:
-            logging.info("Set up chunklist and corresponding encode commands for the Q adjust phase.")
-            print("The encoder parameters for the analysis:", encode_params_displist)
-            print("\n")
-            run_encode(qadjust_cycle, chunklist, video_length, fr, max_parallel_encodes, encode_commands, chunklist_dict, start_time)
-            concatenate(chunks_folder, input_files, output_final_ssimu2, fr, use_mkvmerge, encoder)
-            chunklist, average_firstpass = calculate_ssimu2(chunklist, qadjust_skip, qadjust_cycle, qadjust_original_file, output_final_ssimu2, encode_script, output_final, video_matrix, qadjust_verify, percentile_5_total_firstpass,
-                                                            encoder, q, br, qadjust_results_file, qadjust_final_results_file, qadjust_firstpass_data, qadjust_final_data, average_firstpass)
-        qadjust_cycle = 2
-        clean_files(chunks_folder, 'encoded')
-        encode_commands = []
-        input_files = []
-        encode_commands, input_files, chunklist, chunklist_dict, encode_params = preprocess_chunks(encode_commands, input_files, chunklist, qadjust_cycle, stored_encode_params, scd_method, scene_changes, video_length, scene_change_csv,
-                                                                                                   credits_start_frame, min_chunk_length, q, credits_q, encoder, chunks_folder, rpu, qadjust_cpu, encode_script, qadjust_original_file,
-                                                                                                   video_width, video_height, qadjust_b, qadjust_c, scripts_folder, decode_method, cpu, credits_cpu, qadjust_crop, qadjust_crop_values)
-        encode_params_displist = " ".join(encode_params)
-        encode_params_displist = encode_params_displist.replace('  ', ' ')
-        print("The encoder parameters for the final encode:", encode_params_displist)
-        print("\n")
-        start_time = datetime.now()
-        run_encode(qadjust_cycle, chunklist, video_length, fr, max_parallel_encodes, encode_commands, chunklist_dict, start_time)
-        concatenate(chunks_folder, input_files, output_final, fr, use_mkvmerge, encoder)
-        if qadjust_verify:
-            calculate_ssimu2(chunklist, qadjust_skip, qadjust_cycle, qadjust_original_file, output_final_ssimu2, encode_script, output_final, video_matrix, qadjust_verify, percentile_5_total_firstpass, encoder, q, br,
-                             qadjust_results_file, qadjust_final_results_file, qadjust_firstpass_data, qadjust_final_data, average_firstpass)
-    else:
-        logging.info("Set up chunklist and corresponding encode commands for the final encode.")
-        print("The encoder parameters for the final encode:", encode_params_displist)
-        print("\n")
-        run_encode(qadjust_cycle, chunklist, video_length, fr, max_parallel_encodes, encode_commands, chunklist_dict, start_time)
-        concatenate(chunks_folder, input_files, output_final, fr, use_mkvmerge, encoder)
-
-    end_time_total = datetime.now()
-    total_duration = end_time_total - start_time_total
+            logging.info("Set up chunklist and corresponding encode commands for the final encode.")
+            final_encode(chunklist, encode_commands, input_files, encode_params_displist, start_time)
+
+    end_time_total = time.monotonic()
+    total_duration = timedelta(seconds=end_time_total - start_time_total)
     logging.info(f"Process finished, total duration {total_duration}.")
 
 